@@ -17,6 +17,9 @@
     'license': 'AGPL-3',
     'depends': ['account'],
     'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
+        'views/invoice_merge_job_view.xml',
         'wizard/invoice_merge_view.xml',
     ],
     'installable': True,
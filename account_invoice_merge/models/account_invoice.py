@@ -5,9 +5,29 @@
 # © 2016 Luc De Meyer <luc.demeyer@noviat.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from collections import Counter, OrderedDict, defaultdict
+from itertools import izip
+import time
+
 from openerp import models, api
 from openerp import workflow
-from openerp.osv.orm import browse_record, browse_null
+from openerp.models import MAGIC_COLUMNS
+from openerp.tools.misc import split_every
+
+
+def _split_groups(groups, size):
+    """Split a list of (key, ids) groups in chunks of about ``size`` ids"""
+    chunk = []
+    count = 0
+    for group in groups:
+        chunk.append(group)
+        count += len(group[1])
+        if count >= size:
+            yield chunk
+            chunk = []
+            count = 0
+    if chunk:
+        yield chunk
 
 
 class AccountInvoice(models.Model):
@@ -31,6 +51,34 @@ class AccountInvoice(models.Model):
                 fields.append(field)
         return fields
 
+    @api.model
+    def _get_merge_keys(self, records, fields, rows=None):
+        """Compute the merge keys of a batch of records.
+        The values of all the records are read at once and each key is a
+        plain tuple of the values in sorted field order. The ids of x2many
+        fields are sorted once per record and equal tuples are shared.
+        :param records: recordset to compute the keys of
+        :param fields: names of the fields making the key
+        :param rows: values of the records as returned by read(), when
+            they are already loaded
+        :return: dictionary {record id: key}
+        """
+        fields = sorted(set(fields))
+        if rows is None:
+            rows = records.read(fields, load='_classic_write')
+        ids = [row['id'] for row in rows]
+        if not fields:
+            return dict.fromkeys(ids, ())
+        columns = []
+        ids_tuples = {}
+        for field in fields:
+            column = [row[field] for row in rows]
+            if records._fields[field].type in ('one2many', 'many2many'):
+                column = [ids_tuples.setdefault(value, value) for value in
+                          (tuple(sorted(value)) for value in column)]
+            columns.append(column)
+        return dict(izip(ids, izip(*columns)))
+
     @api.model
     def _get_first_invoice_fields(self, invoice):
         return {
@@ -73,7 +121,444 @@ class AccountInvoice(models.Model):
         return self.filtered(lambda x: x.state == 'draft')
 
     @api.multi
-    def do_merge(self, keep_references=True, date_invoice=False):
+    def _get_merge_invoice_key_groups(self):
+        """Split the draft invoices of the selection by merge key.
+        :return: ordered dictionary {invoice key: list of invoice ids}, in
+            the order of the selection
+        """
+        invoices = self._get_draft_invoices()
+        keys = self._get_merge_keys(invoices, self._get_invoice_key_cols())
+        groups = OrderedDict()
+        for invoice_id in invoices.ids:
+            groups.setdefault(keys[invoice_id], []).append(invoice_id)
+        return groups
+
+    @api.multi
+    def _get_merge_invoice_groups(self):
+        """Split the draft invoices of the selection by merge key.
+        :return: list of lists of invoice ids sharing the same key, in the
+            order of the selection
+        """
+        return self._get_merge_invoice_key_groups().values()
+
+    @api.multi
+    def _iter_merge_preview(self, chunk_size=1000):
+        """Yield, group by group, the invoices do_merge would create.
+        The lines are read about ``chunk_size`` invoices at a time, so that
+        very large selections are previewed with a bounded memory usage.
+        """
+        key_cols = sorted(set(self._get_invoice_key_cols()))
+        line_key_cols = self._get_invoice_line_key_cols()
+        line_model = self.env['account.invoice.line']
+        groups = [(key, invoice_ids) for key, invoice_ids
+                  in self._get_merge_invoice_key_groups().iteritems()
+                  if len(invoice_ids) > 1]
+        for chunk in _split_groups(groups, chunk_size):
+            lines = line_model.search(
+                [('invoice_id', 'in', [invoice_id for __, invoice_ids in chunk
+                                       for invoice_id in invoice_ids])])
+            rows = lines.read(
+                line_key_cols + ['invoice_id'], load='_classic_write')
+            line_keys = self._get_merge_keys(lines, line_key_cols, rows=rows)
+            keys_by_invoice = defaultdict(list)
+            for row in rows:
+                keys_by_invoice[row['invoice_id']].append(
+                    line_keys[row['id']])
+            for key, invoice_ids in chunk:
+                line_counts = Counter(
+                    line_key for invoice_id in invoice_ids
+                    for line_key in keys_by_invoice[invoice_id])
+                yield {
+                    'key': dict(izip(key_cols, key)),
+                    'invoice_ids': invoice_ids,
+                    'line_count': sum(line_counts.itervalues()),
+                    'merged_line_count': len(line_counts),
+                    'collision_count': len(
+                        [c for c in line_counts.itervalues() if c > 1]),
+                }
+            self.env.invalidate_all()
+
+    @api.multi
+    def merge_preview(self, chunk_size=1000):
+        """Preview the merge of the selection without writing anything.
+        :return: dictionary with the groups do_merge would create (see
+            _iter_merge_preview), the number of invoices and lines read and
+            created, and an estimate of the merge duration in seconds based
+            on the throughput of the previous merge jobs (False when there
+            is no previous job)
+        """
+        start = time.time()
+        groups = list(self._iter_merge_preview(chunk_size=chunk_size))
+        invoice_count = sum(len(group['invoice_ids']) for group in groups)
+        line_count = sum(group['line_count'] for group in groups)
+        new_line_count = sum(group['merged_line_count'] for group in groups)
+        lines_per_second = \
+            self.env['invoice.merge.job.group']._get_lines_per_second()
+        return {
+            'groups': groups,
+            'invoice_count': invoice_count,
+            'new_invoice_count': len(groups),
+            'line_count': line_count,
+            'new_line_count': new_line_count,
+            'inserted_rows': len(groups) + new_line_count,
+            'updated_rows': invoice_count,
+            'estimated_duration': (
+                line_count / lines_per_second if lines_per_second
+                else False),
+            'preview_duration': time.time() - start,
+        }
+
+    @api.model
+    def _get_merge_line_bulk_fields(self):
+        """Return the names of the invoice line fields copied by the bulk
+        merge, as a tuple (columns, many2many fields).
+        Computed fields are left out: they are recomputed once the lines
+        are inserted.
+        """
+        line_model = self.env['account.invoice.line']
+        columns = []
+        m2m_fields = []
+        for name, field in line_model._fields.iteritems():
+            if name in MAGIC_COLUMNS or not field.store or field.compute:
+                continue
+            column = line_model._columns.get(name)
+            if column is None:
+                continue
+            if field.type == 'many2many':
+                m2m_fields.append(name)
+            elif field.type != 'one2many' and column._classic_write:
+                columns.append(name)
+        return columns, m2m_fields
+
+    @api.model
+    def _merge_bulk_create_lines(self, lines_by_invoice):
+        """Insert the merged invoice lines with multi-row inserts.
+        :param lines_by_invoice: list of tuples (new invoice id, list of
+            line values as built by do_merge)
+        :return: dictionary {new invoice id: {old line id: new line id}}
+        """
+        cr = self.env.cr
+        uid = self.env.uid
+        line_model = self.env['account.invoice.line']
+        columns, m2m_fields = self._get_merge_line_bulk_fields()
+        res = {}
+        rows = []
+        count = sum(len(lines) for __, lines in lines_by_invoice)
+        if not count:
+            return res
+        cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                   (line_model._sequence, count))
+        new_ids = iter([row[0] for row in cr.fetchall()])
+        for invoice_id, lines in lines_by_invoice:
+            res[invoice_id] = {}
+            for vals in lines:
+                line_id = next(new_ids)
+                vals['invoice_id'] = invoice_id
+                for o_line_id in vals['o_line_ids']:
+                    res[invoice_id][o_line_id] = line_id
+                rows.append((line_id, vals))
+        sql_columns = ['id'] + columns
+        placeholders = '(%s, %s, %s, %s, %s)' % (
+            ', '.join(['%s'] * len(sql_columns)),
+            uid, "(now() at time zone 'UTC')",
+            uid, "(now() at time zone 'UTC')")
+        query = 'INSERT INTO "%s" (%s, create_uid, create_date, ' \
+                'write_uid, write_date) VALUES ' % (
+                    line_model._table,
+                    ', '.join('"%s"' % name for name in sql_columns))
+        for chunk in split_every(cr.IN_MAX, rows):
+            params = []
+            for line_id, vals in chunk:
+                params.append(line_id)
+                for name in columns:
+                    value = vals.get(name, False)
+                    if value is False and \
+                            line_model._fields[name].type != 'boolean':
+                        value = None
+                    params.append(value)
+            # only the table, the columns and the placeholders are formatted
+            # pylint: disable=sql-injection
+            cr.execute(query + ', '.join([placeholders] * len(chunk)),
+                       params)
+        for name in m2m_fields:
+            rel, col1, col2 = line_model._columns[name]._sql_names(
+                line_model)
+            rel_rows = [(line_id, rel_id) for line_id, vals in rows
+                        for rel_id in vals.get(name) or []]
+            rel_query = 'INSERT INTO "%s" ("%s", "%s") VALUES ' % (
+                rel, col1, col2)
+            for chunk in split_every(cr.IN_MAX, rel_rows):
+                # pylint: disable=sql-injection
+                cr.execute(rel_query + ', '.join(['(%s, %s)'] * len(chunk)),
+                           [v for row in chunk for v in row])
+        self._merge_recompute_stored(
+            'account.invoice.line', [line_id for line_id, __ in rows],
+            list(line_model._fields))
+        return res
+
+    @api.model
+    def _merge_recompute_stored(self, model_name, ids, fnames):
+        """Recompute the stored fields depending on ``fnames`` for records
+        written with SQL queries, the same way the ORM does after a write.
+        """
+        cr, uid, context = self.env.args
+        self.env.invalidate_all()
+        self.env[model_name].browse(ids).modified(fnames)
+        done = []
+        store_values = self.pool[model_name]._store_get_values(
+            cr, uid, ids, fnames, context)
+        for __, store_model, store_ids, store_fnames in sorted(store_values):
+            if (store_model, store_ids, store_fnames) not in done:
+                self.pool[store_model]._store_set_values(
+                    cr, uid, store_ids, store_fnames, context)
+                done.append((store_model, store_ids, store_fnames))
+        self.env[model_name].recompute()
+
+    @api.model
+    def _get_merge_mappings(self, invoices_info, invoice_lines_info):
+        """Flatten the result of do_merge.
+        :return: tuple of dictionaries ({old invoice id: new invoice id},
+            {old line id: new line id})
+        """
+        invoice_mapping = dict(
+            (old_id, new_id) for new_id, old_ids in invoices_info.iteritems()
+            for old_id in old_ids)
+        line_mapping = {}
+        for lines_info in invoice_lines_info.itervalues():
+            line_mapping.update(lines_info)
+        return invoice_mapping, line_mapping
+
+    @api.model
+    def _merge_relink_many2many(self, model_name, field_name, mapping,
+                                replace=True):
+        """Link the records of ``model_name`` pointing to merged records
+        through the many2many ``field_name`` to the records replacing them,
+        with set-based queries on the relation table.
+        :param mapping: dictionary {merged record id: new record id}
+        :param replace: if True, remove the links to the merged records
+        :return: ids of the relinked records of ``model_name``
+        """
+        cr = self.env.cr
+        model = self.env[model_name]
+        rel, col1, col2 = model._columns[field_name]._sql_names(model)
+        relinked = set()
+        for chunk in split_every(cr.IN_MAX, mapping.items()):
+            query = """
+                INSERT INTO "{rel}" ("{col1}", "{col2}")
+                SELECT DISTINCT rel."{col1}", map.new_id
+                FROM "{rel}" rel
+                JOIN (VALUES {values}) AS map (old_id, new_id)
+                    ON map.old_id = rel."{col2}"
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM "{rel}" rel2
+                    WHERE rel2."{col1}" = rel."{col1}"
+                        AND rel2."{col2}" = map.new_id)
+                RETURNING "{col1}"
+                """.format(rel=rel, col1=col1, col2=col2,
+                           values=', '.join(['(%s, %s)'] * len(chunk)))
+            # only the relation table, its columns and the placeholders are
+            # formatted
+            # pylint: disable=sql-injection
+            cr.execute(query, [value for item in chunk for value in item])
+            relinked.update(row[0] for row in cr.fetchall())
+            if replace:
+                query = """
+                    DELETE FROM "{rel}" WHERE "{col2}" IN %s
+                    RETURNING "{col1}"
+                    """.format(rel=rel, col1=col1, col2=col2)
+                # pylint: disable=sql-injection
+                cr.execute(query, (tuple(old_id for old_id, __ in chunk),))
+                relinked.update(row[0] for row in cr.fetchall())
+        if relinked:
+            self._merge_recompute_stored(
+                model_name, list(relinked), [field_name])
+        return list(relinked)
+
+    @api.model
+    def _merge_sum_taxes(self, invoices_info, invoice_lines_info):
+        """Build the tax lines of the new invoices by summing the computed
+        tax lines of the merged invoices, grouped like
+        account.invoice.tax compute does.
+        The sum is only exact when the taxes are rounded per line, no line
+        was merged with another one and no currency conversion is involved.
+        Otherwise, or when a merged invoice has taxed lines but no tax line
+        (taxes never computed), the taxes have to be fully recomputed.
+        :return: the new invoices whose taxes must be recomputed
+        """
+        cr = self.env.cr
+        to_reset = self.browse()
+        to_sum = {}
+        for invoice in self.browse(invoices_info.keys()):
+            lines_info = invoice_lines_info[invoice.id]
+            company = invoice.company_id
+            if company.tax_calculation_rounding_method != 'round_per_line' \
+                    or invoice.currency_id != company.currency_id \
+                    or len(set(lines_info.values())) < len(lines_info):
+                to_reset |= invoice
+            else:
+                for old_id in invoices_info[invoice.id]:
+                    to_sum[old_id] = invoice.id
+        if to_sum:
+            cr.execute("""
+                SELECT DISTINCT l.invoice_id
+                FROM account_invoice_line l
+                JOIN account_invoice_line_tax rel
+                    ON rel.invoice_line_id = l.id
+                WHERE l.invoice_id IN %s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM account_invoice_tax t
+                        WHERE t.invoice_id = l.invoice_id
+                            AND NOT t.manual)
+                """, (tuple(to_sum),))
+            for row in cr.fetchall():
+                to_reset |= self.browse(to_sum[row[0]])
+            for old_id, new_id in to_sum.items():
+                if new_id in to_reset.ids:
+                    del to_sum[old_id]
+        tax_ids = []
+        for chunk in split_every(cr.IN_MAX, to_sum.items()):
+            query = """
+                INSERT INTO account_invoice_tax (
+                    invoice_id, name, sequence, manual, company_id,
+                    account_id, account_analytic_id, base_code_id,
+                    tax_code_id, base, amount, base_amount, tax_amount,
+                    create_uid, create_date, write_uid, write_date)
+                SELECT map.new_id, min(t.name), min(t.sequence), false,
+                    t.company_id, t.account_id, t.account_analytic_id,
+                    t.base_code_id, t.tax_code_id, sum(t.base),
+                    sum(t.amount), sum(t.base_amount), sum(t.tax_amount),
+                    %s, (now() at time zone 'UTC'),
+                    %s, (now() at time zone 'UTC')
+                FROM account_invoice_tax t
+                JOIN (VALUES {values}) AS map (old_id, new_id)
+                    ON map.old_id = t.invoice_id
+                WHERE NOT t.manual
+                GROUP BY map.new_id, t.company_id, t.account_id,
+                    t.account_analytic_id, t.base_code_id, t.tax_code_id
+                RETURNING id
+                """.format(values=', '.join(['(%s, %s)'] * len(chunk)))
+            # only the placeholders of the values are formatted
+            # pylint: disable=sql-injection
+            cr.execute(query, [self.env.uid, self.env.uid] +
+                       [value for item in chunk for value in item])
+            tax_ids.extend(row[0] for row in cr.fetchall())
+        if tax_ids:
+            tax_model = self.env['account.invoice.tax']
+            self._merge_recompute_stored(
+                'account.invoice.tax', tax_ids, list(tax_model._fields))
+        return to_reset
+
+    @api.model
+    def _merge_redirect_workflow(self, invoice_mapping):
+        """Make the workflow items waiting on the merged invoices (sale or
+        purchase order subflows) wait on the new invoices, for all the
+        merged invoices at once. Same as workflow.trg_redirect.
+        :param invoice_mapping: dictionary {old invoice id: new invoice id}
+        """
+        cr = self.env.cr
+        for chunk in split_every(cr.IN_MAX, invoice_mapping.items()):
+            query = """
+                UPDATE wkf_workitem wi
+                SET subflow_id = new_inst.id
+                FROM wkf_instance old_inst,
+                    (VALUES {values}) AS map (old_id, new_id),
+                    wkf_instance new_inst
+                WHERE wi.subflow_id = old_inst.id
+                    AND old_inst.res_type = %s
+                    AND old_inst.res_id = map.old_id
+                    AND new_inst.res_type = old_inst.res_type
+                    AND new_inst.res_id = map.new_id
+                    AND new_inst.wkf_id = old_inst.wkf_id
+                    AND new_inst.state = 'active'
+                """.format(values=', '.join(['(%s, %s)'] * len(chunk)))
+            # only the placeholders of the values are formatted
+            # pylint: disable=sql-injection
+            cr.execute(query, [value for item in chunk for value in item] +
+                       [self._name])
+
+    @api.model
+    def _merge_cancel_invoices(self, invoice_ids):
+        """Cancel the merged invoices, all at once.
+        The merged invoices are drafts without any move: action_cancel is
+        called once on all of them and their workflow instances are moved
+        to the cancel activity with SQL queries, instead of running the
+        cancel transition invoice by invoice. Invoices whose workflow is not
+        waiting on the draft activity go through the workflow engine.
+        """
+        if not invoice_ids:
+            return
+        cr = self.env.cr
+        draft_act = self.env.ref('account.act_draft')
+        cancel_act = self.env.ref('account.act_cancel')
+        invoices = self.browse(invoice_ids)
+        fast_ids = []
+        if cancel_act.flow_stop and draft_act.out_transitions.filtered(
+                lambda t: t.act_to == cancel_act and
+                t.signal == 'invoice_cancel' and
+                t.condition == 'True'):
+            candidates = invoices.filtered(
+                lambda inv: inv.state == 'draft' and not inv.move_id)
+            for chunk in cr.split_for_in_conditions(candidates.ids):
+                cr.execute("""
+                    SELECT inst.res_id
+                    FROM wkf_instance inst
+                    JOIN wkf_workitem wi ON wi.inst_id = inst.id
+                    WHERE inst.res_type = %s
+                        AND inst.res_id IN %s
+                        AND inst.state = 'active'
+                    GROUP BY inst.res_id
+                    HAVING bool_and(wi.act_id = %s)
+                    """, (self._name, chunk, draft_act.id))
+                fast_ids.extend(row[0] for row in cr.fetchall())
+        if fast_ids:
+            self.browse(fast_ids).action_cancel()
+            for chunk in cr.split_for_in_conditions(fast_ids):
+                cr.execute("""
+                    UPDATE wkf_workitem
+                    SET act_id = %s, state = 'complete'
+                    WHERE inst_id IN (
+                        SELECT id FROM wkf_instance
+                        WHERE res_type = %s AND res_id IN %s)
+                    """, (cancel_act.id, self._name, chunk))
+                cr.execute("""
+                    UPDATE wkf_instance SET state = 'complete'
+                    WHERE res_type = %s AND res_id IN %s
+                    """, (self._name, chunk))
+        for invoice_id in set(invoice_ids) - set(fast_ids):
+            workflow.trg_validate(
+                self.env.uid, self._name, invoice_id, 'invoice_cancel', cr)
+
+    @api.model
+    def _merge_relink_analytic_lines(self, invoice_mapping):
+        """Point the analytic lines (invoice time sheet for example) of the
+        merged invoices to the new invoices with set-based updates.
+        :param invoice_mapping: dictionary {old invoice id: new invoice id}
+        """
+        cr = self.env.cr
+        line_ids = []
+        for chunk in split_every(cr.IN_MAX, invoice_mapping.items()):
+            query = """
+                UPDATE account_analytic_line aal
+                SET invoice_id = map.new_id,
+                    write_uid = %s,
+                    write_date = (now() at time zone 'UTC')
+                FROM (VALUES {values}) AS map (old_id, new_id)
+                WHERE aal.invoice_id = map.old_id
+                RETURNING aal.id
+                """.format(values=', '.join(['(%s, %s)'] * len(chunk)))
+            # only the placeholders of the values are formatted
+            # pylint: disable=sql-injection
+            cr.execute(query, [self.env.uid] +
+                       [value for item in chunk for value in item])
+            line_ids.extend(row[0] for row in cr.fetchall())
+        if line_ids:
+            self._merge_recompute_stored(
+                'account.analytic.line', line_ids, ['invoice_id'])
+        return line_ids
+
+    @api.multi
+    def do_merge(self, keep_references=True, date_invoice=False, bulk=False,
+                 sum_taxes=False):
         """
         To merge similar type of account invoices.
         Invoices will only be merged if:
@@ -86,28 +571,34 @@ class AccountInvoice(models.Model):
 
          @param self: The object pointer.
          @param keep_references: If True, keep reference of original invoices
+         @param bulk: If True, read the values of all the lines at once and
+                      insert the merged lines with multi-row inserts
+                      instead of one create per line
+         @param sum_taxes: If True, build the tax lines of the new invoices
+                           by summing the tax lines of the merged invoices
+                           when it gives the same result as a full
+                           computation
 
          @return: new account invoice id
 
         """
-        def make_key(br, fields):
-            list_key = []
-            for field in fields:
-                field_val = getattr(br, field)
-                if field in ('product_id', 'account_id'):
-                    if not field_val:
-                        field_val = False
-                if (isinstance(field_val, browse_record) and
-                   field != 'invoice_line_tax_id'):
-                    field_val = field_val.id
-                elif isinstance(field_val, browse_null):
-                    field_val = False
-                elif (isinstance(field_val, list) or
-                      field == 'invoice_line_tax_id'):
-                    field_val = ((6, 0, tuple([v.id for v in field_val])),)
-                list_key.append((field, field_val))
-            list_key.sort()
-            return tuple(list_key)
+        draft_invoices = self._get_draft_invoices()
+        draft_lines = draft_invoices.mapped('invoice_line')
+        invoice_keys = self._get_merge_keys(
+            draft_invoices, self._get_invoice_key_cols())
+        line_key_cols = self._get_invoice_line_key_cols()
+        if bulk:
+            # load the line values along with the keys
+            line_columns, line_m2m_fields = \
+                self._get_merge_line_bulk_fields()
+            line_rows = dict(
+                (row['id'], row) for row in draft_lines.read(
+                    list(set(line_columns + line_m2m_fields +
+                             line_key_cols)), load='_classic_write'))
+            line_keys = self._get_merge_keys(
+                draft_lines, line_key_cols, rows=line_rows.values())
+        else:
+            line_keys = self._get_merge_keys(draft_lines, line_key_cols)
 
         # compute what the new invoices should contain
 
@@ -116,9 +607,8 @@ class AccountInvoice(models.Model):
         seen_client_refs = {}
         line_sequence = 1
 
-        for account_invoice in self._get_draft_invoices():
-            invoice_key = make_key(
-                account_invoice, self._get_invoice_key_cols())
+        for account_invoice in draft_invoices:
+            invoice_key = invoice_keys[account_invoice.id]
             new_invoice = new_invoices.setdefault(invoice_key, ({}, []))
             origins = seen_origins.setdefault(invoice_key, set())
             client_refs = seen_client_refs.setdefault(invoice_key, set())
@@ -149,16 +639,19 @@ class AccountInvoice(models.Model):
                         (' %s' % (account_invoice.reference,))
                     client_refs.add(account_invoice.reference)
             for invoice_line in account_invoice.invoice_line:
-                line_key = make_key(
-                    invoice_line, self._get_invoice_line_key_cols())
+                line_key = line_keys[invoice_line.id]
                 o_line = invoice_infos['invoice_line'].setdefault(line_key, {})
                 if o_line:
                     self._merge_invoice_line_values(o_line, invoice_line)
                     o_line['o_line_ids'].append(invoice_line.id)
                 else:
                     # append a new "standalone" line
-                    o_line.update(
-                        invoice_line._convert_to_write(invoice_line._cache))
+                    if bulk:
+                        o_line.update(line_rows[invoice_line.id])
+                        del o_line['id']
+                    else:
+                        o_line.update(invoice_line._convert_to_write(
+                            invoice_line._cache))
                     if 'invoice_id' in o_line:
                         del o_line['invoice_id']
                     o_line['o_line_ids'] = [invoice_line.id]
@@ -166,6 +659,8 @@ class AccountInvoice(models.Model):
                     line_sequence += 1
         invoices_info = {}
         invoice_lines_info = {}
+        new_invoice_ids = []
+        bulk_lines = []
         for invoice_key, (invoice_data, old_ids) in new_invoices.iteritems():
             # skip merges with only one invoice
             if len(old_ids) < 2:
@@ -176,6 +671,12 @@ class AccountInvoice(models.Model):
             invoice_line_data = invoice_data['invoice_line']
             del invoice_data['invoice_line']
             newinvoice = self.with_context(is_merge=True).create(invoice_data)
+            new_invoice_ids.append(newinvoice.id)
+            invoices_info.update({newinvoice.id: old_ids})
+            if bulk:
+                bulk_lines.append(
+                    (newinvoice.id, invoice_line_data.values()))
+                continue
             invoice_lines_info[newinvoice.id] = {}
             for entry in invoice_line_data.values():
                 o_line_ids = entry['o_line_ids']
@@ -184,47 +685,34 @@ class AccountInvoice(models.Model):
                 inv_line = self.env['account.invoice.line'].create(entry)
                 for o_line_id in o_line_ids:
                     invoice_lines_info[newinvoice.id][o_line_id] = inv_line.id
+        if bulk:
+            invoice_lines_info.update(
+                self._merge_bulk_create_lines(bulk_lines))
+        if sum_taxes:
+            reset_invoices = self._merge_sum_taxes(
+                invoices_info, invoice_lines_info)
+        else:
+            reset_invoices = self.browse(new_invoice_ids)
+        for newinvoice in reset_invoices:
             newinvoice.button_reset_taxes()
-            invoices_info.update({newinvoice.id: old_ids})
-            # make triggers pointing to the old invoices point to the new
-            # invoice
-            for old_id in old_ids:
-                workflow.trg_redirect(
-                    self.env.uid, 'account.invoice', old_id, newinvoice.id,
-                    self.env.cr)
-                workflow.trg_validate(
-                    self.env.uid, 'account.invoice', old_id, 'invoice_cancel',
-                    self.env.cr)
-        # make link between original sale order if sale is not installed
-        # None if purchase is not installed
+        invoice_mapping, line_mapping = self._get_merge_mappings(
+            invoices_info, invoice_lines_info)
+        # make triggers pointing to the old invoices point to the new
+        # invoice
+        self._merge_redirect_workflow(invoice_mapping)
+        self._merge_cancel_invoices(invoice_mapping.keys())
+        # make link between original sale order if sale is installed
         if 'sale.order' in self.env.registry:
-            so_obj = self.env['sale.order']
-            for new_invoice_id in invoices_info:
-                todos = so_obj.search(
-                    [('invoice_ids', 'in', invoices_info[new_invoice_id])])
-                todos.write({'invoice_ids': [(4, new_invoice_id)]})
-                for org_so in todos:
-                    for so_line in org_so.order_line:
-                        org_ilines = so_line.mapped('invoice_lines')
-                        invoice_line_ids = []
-                        for org_iline in org_ilines:
-                            # the sale.order, _prepare_invoice method
-                            # allows to remove created invoice lines
-                            # from the final sale order invoice.
-                            # We need as a consequence to add a check.
-                            if org_iline.id \
-                                    in invoice_lines_info[new_invoice_id]:
-                                invoice_line_ids.append(
-                                    invoice_lines_info[
-                                        new_invoice_id][org_iline.id])
-                        so_line.write(
-                            {'invoice_lines': [(6, 0, invoice_line_ids)]})
+            self._merge_relink_many2many(
+                'sale.order', 'invoice_ids', invoice_mapping, replace=False)
+            # the sale.order, _prepare_invoice method allows to remove
+            # created invoice lines from the final sale order invoice,
+            # only the lines of the merged invoices are relinked.
+            self._merge_relink_many2many(
+                'sale.order.line', 'invoice_lines', line_mapping)
         # recreate link (if any) between original analytic account line
         # (invoice time sheet for example) and this new invoice
         anal_line_obj = self.env['account.analytic.line']
         if 'invoice_id' in anal_line_obj._columns:
-            for new_invoice_id in invoices_info:
-                todos = anal_line_obj.search(
-                    [('invoice_id', 'in', invoices_info[new_invoice_id])])
-                todos.write({'invoice_id': new_invoice_id})
+            self._merge_relink_analytic_lines(invoice_mapping)
         return invoices_info, invoice_lines_info
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from datetime import datetime, timedelta
+
+from openerp import api, fields, models
+
+
+class InvoiceMergeAuto(models.Model):
+    _name = 'invoice.merge.auto'
+    _description = 'Invoice Auto-Merge Rule'
+    _order = 'sequence, id'
+
+    name = fields.Char(required=True)
+    active = fields.Boolean(default=True)
+    sequence = fields.Integer(default=10)
+    company_id = fields.Many2one(
+        'res.company', string='Company', required=True,
+        default=lambda self: self.env.user.company_id)
+    invoice_type = fields.Selection(
+        [('out_invoice', 'Customer Invoice'),
+         ('in_invoice', 'Supplier Invoice'),
+         ('out_refund', 'Customer Refund'),
+         ('in_refund', 'Supplier Refund')],
+        required=True, default='out_invoice')
+    journal_ids = fields.Many2many(
+        'account.journal', string='Journals',
+        help="Only merge the draft invoices of these journals. Leave empty "
+             "to merge the invoices of all the journals.")
+    partner_category_ids = fields.Many2many(
+        'res.partner.category', string='Partner Tags',
+        help="Only merge the draft invoices of partners having one of these "
+             "tags. Leave empty to merge the invoices of all the partners.")
+    min_age = fields.Integer(
+        string='Minimum Age (days)',
+        help="Only merge the draft invoices created at least this number of "
+             "days ago.")
+    keep_references = fields.Boolean(
+        string='Keep references from original invoices', default=True)
+    sum_taxes = fields.Boolean(
+        string='Sum Taxes of Original Invoices',
+        help="Build the taxes of the new invoices by summing the taxes of "
+             "the original invoices instead of computing them again, when "
+             "it gives the same result.")
+    workers = fields.Integer(
+        default=1, required=True,
+        help="Number of invoice groups merged in parallel, each one in its "
+             "own transaction.")
+    time_budget = fields.Integer(
+        string='Time Budget (minutes)',
+        help="No new group of invoices is merged once this time is elapsed; "
+             "the remaining groups are merged by the next run. Leave empty "
+             "for no limit.")
+    job_ids = fields.One2many(
+        'invoice.merge.job', 'rule_id', string='Jobs', readonly=True)
+
+    @api.multi
+    def _get_invoice_domain(self):
+        self.ensure_one()
+        domain = [
+            ('state', '=', 'draft'),
+            ('type', '=', self.invoice_type),
+            ('company_id', '=', self.company_id.id),
+        ]
+        if self.journal_ids:
+            domain.append(('journal_id', 'in', self.journal_ids.ids))
+        if self.partner_category_ids:
+            domain.append(
+                ('partner_id.category_id', 'in',
+                 self.partner_category_ids.ids))
+        if self.min_age:
+            domain.append(
+                ('create_date', '<=', fields.Datetime.to_string(
+                    datetime.now() - timedelta(days=self.min_age))))
+        return domain
+
+    @api.multi
+    def run(self, commit=False):
+        """Merge the draft invoices selected by the rules.
+        A job left unfinished by a previous run (time budget exceeded or
+        interrupted run) is resumed instead of selecting the invoices again.
+        """
+        job_model = self.env['invoice.merge.job']
+        for rule in self:
+            job = rule.job_ids.filtered(
+                lambda j: j.state in ('pending', 'running'))[:1]
+            if not job:
+                invoices = self.env['account.invoice'].search(
+                    rule._get_invoice_domain())
+                job = job_model.create_from_invoices(
+                    invoices, keep_references=rule.keep_references,
+                    sum_taxes=rule.sum_taxes)
+                job.rule_id = rule
+            job.run(commit=commit, workers=rule.workers,
+                    time_budget=rule.time_budget * 60)
+        return True
+
+    @api.multi
+    def button_run(self):
+        return self.run()
+
+    @api.model
+    def _cron_auto_merge(self):
+        return self.search([]).run(commit=True)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+import threading
+import time
+
+import psycopg2
+
+import openerp
+from openerp import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+class InvoiceMergeJob(models.Model):
+    _name = 'invoice.merge.job'
+    _description = 'Invoice Merge Job'
+    _order = 'id desc'
+
+    name = fields.Char(
+        required=True, readonly=True,
+        default=lambda self: fields.Datetime.now())
+    state = fields.Selection(
+        [('pending', 'Pending'),
+         ('running', 'Running'),
+         ('done', 'Done'),
+         ('failed', 'Done with errors')],
+        default='pending', required=True, readonly=True)
+    keep_references = fields.Boolean(
+        string='Keep references from original invoices', default=True)
+    date_invoice = fields.Date('Invoice Date')
+    sum_taxes = fields.Boolean(
+        string='Sum Taxes of Original Invoices',
+        help="Build the taxes of the new invoices by summing the taxes of "
+             "the original invoices instead of computing them again, when "
+             "it gives the same result.")
+    rule_id = fields.Many2one(
+        'invoice.merge.auto', string='Auto-Merge Rule', readonly=True,
+        ondelete='set null')
+    group_ids = fields.One2many(
+        'invoice.merge.job.group', 'job_id', string='Groups', readonly=True)
+    date_start = fields.Datetime('Started on', readonly=True)
+    date_end = fields.Datetime('Ended on', readonly=True)
+    group_count = fields.Integer(compute='_compute_progress')
+    group_done_count = fields.Integer(
+        string='Merged Groups', compute='_compute_progress')
+    group_failed_count = fields.Integer(
+        string='Failed Groups', compute='_compute_progress')
+    line_count = fields.Integer(
+        string='Merged Lines', compute='_compute_progress')
+    duration = fields.Float(
+        string='Merge Time (s)', compute='_compute_progress',
+        help="Time spent merging the processed groups, in seconds")
+    groups_per_second = fields.Float(compute='_compute_progress')
+    lines_per_second = fields.Float(compute='_compute_progress')
+    invoice_count = fields.Integer(
+        string='Merged Invoices', compute='_compute_progress')
+    new_invoice_count = fields.Integer(
+        string='Created Invoices', compute='_compute_progress')
+    collapsed_line_count = fields.Integer(
+        string='Collapsed Lines', compute='_compute_progress',
+        help="Number of lines saved by merging identical lines")
+
+    @api.multi
+    @api.depends('group_ids.state', 'group_ids.line_count',
+                 'group_ids.new_line_count', 'group_ids.duration')
+    def _compute_progress(self):
+        for job in self:
+            done = job.group_ids.filtered(lambda g: g.state == 'done')
+            job.group_count = len(job.group_ids)
+            job.group_done_count = len(done)
+            job.group_failed_count = len(job.group_ids.filtered(
+                lambda g: g.state == 'failed'))
+            job.line_count = sum(done.mapped('line_count'))
+            job.duration = sum(done.mapped('duration'))
+            job.invoice_count = len(done.mapped('invoice_ids'))
+            job.new_invoice_count = len(done.mapped('new_invoice_ids'))
+            job.collapsed_line_count = \
+                job.line_count - sum(done.mapped('new_line_count'))
+            if job.duration:
+                job.groups_per_second = job.group_done_count / job.duration
+                job.lines_per_second = job.line_count / job.duration
+
+    @api.model
+    def create_from_invoices(self, invoices, keep_references=True,
+                             date_invoice=False, sum_taxes=False):
+        """Create a job merging the given invoices, split in one group per
+        invoice merge key. Groups with a single invoice are left out as
+        there is nothing to merge.
+        """
+        groups = [
+            (0, 0, {'sequence': sequence,
+                    'invoice_ids': [(6, 0, invoice_ids)]})
+            for sequence, invoice_ids in enumerate(
+                invoices._get_merge_invoice_groups())
+            if len(invoice_ids) > 1]
+        return self.create({
+            'keep_references': keep_references,
+            'date_invoice': date_invoice,
+            'sum_taxes': sum_taxes,
+            'group_ids': groups,
+        })
+
+    @api.multi
+    def run(self, commit=False, workers=1, time_budget=0):
+        """Merge the pending groups of the jobs.
+        Each group is merged in its own savepoint, so that a failing group
+        does not roll back the others.
+        :param commit: commit after each group, so that an interrupted run
+            resumes after the last merged group
+        :param workers: number of groups merged in parallel, each worker
+            using its own transaction (only when ``commit`` is set)
+        :param time_budget: number of seconds after which no new group is
+            started; the remaining groups are merged by the next run
+        """
+        deadline = time_budget and time.time() + time_budget
+        for job in self:
+            start = time.time()
+            job.write({
+                'state': 'running',
+                'date_start': job.date_start or fields.Datetime.now(),
+            })
+            groups = job.group_ids.filtered(lambda g: g.state == 'pending')
+            if commit and workers > 1 and len(groups) > 1:
+                self.env.cr.commit()
+                job._run_parallel(groups, workers, deadline)
+            else:
+                if commit:
+                    self.env.cr.commit()
+                groups._run(commit=commit, deadline=deadline)
+            job._log_run(groups, time.time() - start)
+            if not job.group_ids.filtered(lambda g: g.state == 'pending'):
+                job.write({
+                    'state': 'failed' if job.group_failed_count else 'done',
+                    'date_end': fields.Datetime.now(),
+                })
+            if commit:
+                self.env.cr.commit()
+        return True
+
+    @api.multi
+    def _run_parallel(self, groups, workers, deadline):
+        """Merge the groups with ``workers`` threads, each one with its own
+        cursor and committing after each group.
+        """
+        self.ensure_one()
+        threads = []
+        for index in range(min(workers, len(groups))):
+            thread = threading.Thread(
+                target=self._run_worker,
+                args=(self.env.cr.dbname, self.env.uid, self.env.context,
+                      groups.ids[index::workers], deadline),
+                name='invoice_merge_job_%s_%s' % (self.id, index))
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.env.invalidate_all()
+
+    @api.model
+    def _run_worker(self, dbname, uid, context, group_ids, deadline):
+        with api.Environment.manage():
+            with openerp.registry(dbname).cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                env['invoice.merge.job.group'].browse(group_ids)._run(
+                    commit=True, deadline=deadline)
+
+    @api.multi
+    def _log_run(self, groups, elapsed):
+        """Log the metrics of a run of the job on ``groups``"""
+        self.ensure_one()
+        self.env.invalidate_all()
+        done = groups.exists().filtered(lambda g: g.state == 'done')
+        line_count = sum(done.mapped('line_count'))
+        _logger.info(
+            "Invoice merge job %s: %d invoices in, %d invoices out, "
+            "%d lines collapsed, %d groups merged in %.2fs "
+            "(%.2f groups/s, %.2f lines/s overall), %d groups left",
+            self.id, len(done.mapped('invoice_ids')),
+            len(done.mapped('new_invoice_ids')),
+            line_count - sum(done.mapped('new_line_count')), len(done),
+            elapsed, self.groups_per_second, self.lines_per_second,
+            len(groups.filtered(lambda g: g.state == 'pending')))
+
+    @api.multi
+    def button_run(self):
+        return self.run()
+
+    @api.multi
+    def button_retry(self):
+        self.mapped('group_ids').filtered(
+            lambda g: g.state == 'failed').write(
+            {'state': 'pending', 'error': False})
+        self.write({'state': 'pending', 'date_end': False})
+        return True
+
+    @api.model
+    def _cron_run_jobs(self):
+        """Run the pending jobs. The jobs of the auto-merge rules are left
+        to the rules, which run them with their workers and time budget.
+        """
+        jobs = self.search(
+            [('state', 'in', ('pending', 'running')),
+             ('rule_id', '=', False)], order='id')
+        return jobs.run(commit=True)
+
+
+class InvoiceMergeJobGroup(models.Model):
+    _name = 'invoice.merge.job.group'
+    _description = 'Invoice Merge Job Group'
+    _order = 'job_id, sequence, id'
+
+    job_id = fields.Many2one(
+        'invoice.merge.job', string='Job', required=True,
+        ondelete='cascade', index=True)
+    sequence = fields.Integer()
+    state = fields.Selection(
+        [('pending', 'Pending'),
+         ('done', 'Done'),
+         ('failed', 'Failed')],
+        default='pending', required=True, readonly=True)
+    invoice_ids = fields.Many2many(
+        'account.invoice', 'invoice_merge_job_group_invoice_rel',
+        'group_id', 'invoice_id', string='Invoices', readonly=True)
+    new_invoice_ids = fields.Many2many(
+        'account.invoice', 'invoice_merge_job_group_new_invoice_rel',
+        'group_id', 'invoice_id', string='Merged Invoices', readonly=True)
+    line_count = fields.Integer(string='Merged Lines', readonly=True)
+    new_line_count = fields.Integer(string='Created Lines', readonly=True)
+    duration = fields.Float(string='Merge Time (s)', readonly=True)
+    error = fields.Text(readonly=True)
+
+    @api.model
+    def _get_lines_per_second(self):
+        """Return the number of lines merged per second by the previous
+        merge jobs, or 0.0 when there is no merged group yet.
+        """
+        self.env.cr.execute("""
+            SELECT sum(line_count), sum(duration)
+            FROM invoice_merge_job_group
+            WHERE state = 'done' AND duration > 0
+            """)
+        line_count, duration = self.env.cr.fetchone()
+        return duration and float(line_count or 0) / duration or 0.0
+
+    @api.multi
+    def _lock(self):
+        """Lock the group for merging.
+        :return: False if the group is merged by another transaction
+        """
+        self.ensure_one()
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    SELECT id FROM invoice_merge_job_group
+                    WHERE id = %s AND state = 'pending'
+                    FOR UPDATE NOWAIT
+                    """, (self.id,))
+                return bool(self.env.cr.fetchone())
+        except psycopg2.OperationalError:
+            return False
+
+    @api.multi
+    def _run(self, commit=False, deadline=0):
+        """Merge the groups one by one, each in its own savepoint.
+        :param commit: commit after each group
+        :param deadline: time after which no new group is started
+        """
+        for group in self:
+            if deadline and time.time() > deadline:
+                break
+            if not group._lock():
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    group._merge()
+            except Exception as e:
+                self.env.invalidate_all()
+                _logger.exception(
+                    "Invoice merge job %s: group %s failed",
+                    group.job_id.id, group.id)
+                group.write({'state': 'failed', 'error': tools.ustr(e)})
+            if commit:
+                self.env.cr.commit()
+        return True
+
+    @api.multi
+    def _merge(self):
+        for group in self:
+            job = group.job_id
+            start = time.time()
+            invoices_info, invoice_lines_info = group.invoice_ids.do_merge(
+                keep_references=job.keep_references,
+                date_invoice=job.date_invoice, bulk=True,
+                sum_taxes=job.sum_taxes)
+            group.write({
+                'state': 'done',
+                'new_invoice_ids': [(6, 0, invoices_info.keys())],
+                'line_count': sum(
+                    len(lines) for lines in invoice_lines_info.values()),
+                'new_line_count': sum(
+                    len(set(lines.values()))
+                    for lines in invoice_lines_info.values()),
+                'duration': time.time() - start,
+                'error': False,
+            })
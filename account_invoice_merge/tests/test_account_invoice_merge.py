@@ -54,6 +54,79 @@ class TestAccountInvoiceMerge(TransactionCase):
             self.assertEqual(
                 len(new_inv_line_ids), len(new_inv.invoice_line._ids),
                 "Incorrect Invoice Line Mapping")
+        self.assertEqual(invoices.mapped('state'), ['cancel', 'cancel'])
+        self.cr.execute(
+            "SELECT state FROM wkf_instance WHERE res_type = %s "
+            "AND res_id IN %s", ('account.invoice', invoices._ids))
+        self.assertEqual(
+            [row[0] for row in self.cr.fetchall()], ['complete', 'complete'])
+
+    def test_invoice_merge_bulk(self):
+        invoices = self.supplier_invoice_1 + self.supplier_invoice_2
+        invoices_info, invoice_lines_info = invoices.do_merge(bulk=True)
+        self.assertEqual(len(invoices_info), 1)
+        for k in invoices_info:
+            new_inv = self.invoice_model.browse(k)
+            self.assertEqual(new_inv.amount_total, 250.0)
+            self.assertEqual(
+                sorted(invoice_lines_info[k].values()),
+                sorted(new_inv.invoice_line._ids),
+                "Incorrect Invoice Line Mapping")
+            self.assertEqual(
+                sorted(invoice_lines_info[k].keys()),
+                sorted(invoices.mapped('invoice_line')._ids))
+        self.assertEqual(invoices.mapped('state'), ['cancel', 'cancel'])
+
+    def test_invoice_merge_sum_taxes(self):
+        tax = self.env['account.tax'].create({
+            'name': 'Merge Tax 21%',
+            'type': 'percent',
+            'amount': 0.21,
+            'type_tax_use': 'purchase',
+        })
+        invoices = self.supplier_invoice_1 + self.supplier_invoice_2
+        invoices.mapped('invoice_line').write(
+            {'invoice_line_tax_id': [(6, 0, [tax.id])]})
+        invoices.button_reset_taxes()
+        invoices_info, invoice_lines_info = invoices.do_merge(
+            bulk=True, sum_taxes=True)
+        new_inv = self.invoice_model.browse(invoices_info.keys())
+        self.assertEqual(len(new_inv.tax_line), 1)
+        self.assertAlmostEqual(new_inv.tax_line.base, 250.0)
+        self.assertAlmostEqual(new_inv.tax_line.amount, 52.5)
+        self.assertAlmostEqual(new_inv.amount_total, 302.5)
+        computed = self.env['account.invoice.tax'].compute(new_inv)
+        self.assertEqual(len(computed), 1)
+        self.assertAlmostEqual(computed.values()[0]['amount'], 52.5)
+
+    def test_merge_keys(self):
+        line_1 = self.supplier_invoice_1.invoice_line
+        line_2 = line_1.copy({'invoice_id': self.supplier_invoice_2.id})
+        line_3 = line_1.copy({'invoice_id': self.supplier_invoice_2.id,
+                              'price_unit': 99.0})
+        keys = self.invoice_model._get_merge_keys(
+            line_1 + line_2 + line_3,
+            self.invoice_model._get_invoice_line_key_cols())
+        self.assertEqual(keys[line_1.id], keys[line_2.id])
+        self.assertNotEqual(keys[line_1.id], keys[line_3.id])
+        invoice_keys = self.invoice_model._get_merge_keys(
+            self.supplier_invoice_1 + self.supplier_invoice_3,
+            self.invoice_model._get_invoice_key_cols())
+        self.assertNotEqual(
+            invoice_keys[self.supplier_invoice_1.id],
+            invoice_keys[self.supplier_invoice_3.id])
+
+    def test_relink_many2many(self):
+        tax_model = self.env['account.tax']
+        tax_1 = tax_model.create({'name': 'Merge Tax 1', 'amount': 0.1})
+        tax_2 = tax_model.create({'name': 'Merge Tax 2', 'amount': 0.2})
+        line = self.supplier_invoice_1.invoice_line
+        line.write({'invoice_line_tax_id': [(6, 0, tax_1.ids)]})
+        relinked = self.invoice_model._merge_relink_many2many(
+            'account.invoice.line', 'invoice_line_tax_id',
+            {tax_1.id: tax_2.id})
+        self.assertEqual(relinked, line.ids)
+        self.assertEqual(line.invoice_line_tax_id, tax_2)
 
     def test_invoice_merge_wizard(self):
         invoices = self.supplier_invoice_1 + self.supplier_invoice_2
@@ -63,9 +136,77 @@ class TestAccountInvoiceMerge(TransactionCase):
         self.assertEqual(
             len(act['domain'][0][2]), 3, "Error in invoice.merge wizard")
 
+    def test_invoice_merge_job(self):
+        invoices = self.supplier_invoice_1 + self.supplier_invoice_2 + \
+            self.supplier_invoice_3
+        job = self.env['invoice.merge.job'].create_from_invoices(invoices)
+        # the invoice of partner 2 has nothing to be merged with
+        self.assertEqual(job.group_count, 1)
+        self.assertEqual(
+            sorted(job.group_ids.invoice_ids._ids),
+            sorted((self.supplier_invoice_1 + self.supplier_invoice_2)._ids))
+        job.run()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.group_done_count, 1)
+        self.assertEqual(job.line_count, 2)
+        self.assertEqual(
+            job.group_ids.new_invoice_ids.amount_total, 250.0)
+        self.assertEqual(self.supplier_invoice_3.state, 'draft')
+
+    def test_invoice_merge_auto(self):
+        rule = self.env['invoice.merge.auto'].create({
+            'name': 'Supplier invoices',
+            'invoice_type': 'in_invoice',
+            'journal_ids': [
+                (6, 0, [self.env.ref('account.expenses_journal').id])],
+        })
+        rule.run()
+        job = rule.job_ids
+        self.assertEqual(len(job), 1)
+        self.assertEqual(job.state, 'done')
+        self.assertTrue(set([self.supplier_invoice_1.id,
+                             self.supplier_invoice_2.id]) <=
+                        set(job.group_ids.mapped('invoice_ids').ids))
+        self.assertEqual(self.supplier_invoice_1.state, 'cancel')
+        self.assertEqual(self.supplier_invoice_3.state, 'draft')
+        self.assertEqual(job.new_invoice_count, len(job.group_ids))
+        # invoices created less than a day ago are left untouched
+        rule.min_age = 1
+        rule.run()
+        self.assertEqual(len(rule.job_ids), 2)
+        self.assertEqual(rule.job_ids[0].group_count, 0)
+
+    def test_merge_preview(self):
+        invoices = self.supplier_invoice_1 + self.supplier_invoice_2 + \
+            self.supplier_invoice_3
+        preview = invoices.merge_preview()
+        self.assertEqual(preview['new_invoice_count'], 1)
+        self.assertEqual(preview['invoice_count'], 2)
+        group = preview['groups'][0]
+        self.assertEqual(
+            sorted(group['invoice_ids']),
+            sorted((self.supplier_invoice_1 + self.supplier_invoice_2)._ids))
+        self.assertEqual(group['key']['partner_id'], self.partner_1.id)
+        self.assertEqual(group['line_count'], 2)
+        self.assertEqual(group['merged_line_count'], 2)
+        self.assertEqual(group['collision_count'], 0)
+        # nothing has been merged
+        self.assertEqual(set(invoices.mapped('state')), set(['draft']))
+
     def test_dirty_check(self):
         invoices = self.supplier_invoice_1 + self.supplier_invoice_3
         ctx = dict(self.wiz_context, active_ids=invoices._ids)
         wiz = self.wiz_model.with_context(ctx).create({})
         with self.assertRaises(UserError):
             wiz._dirty_check()
+
+    def test_dirty_report(self):
+        self.supplier_invoice_3.signal_workflow('invoice_cancel')
+        invoices = self.supplier_invoice_1 + self.supplier_invoice_2 + \
+            self.supplier_invoice_3
+        report = self.wiz_model._get_dirty_report(invoices._ids)
+        # both the state and the partner conflicts are reported
+        self.assertEqual(len(report), 2)
+        self.assertIn(self.partner_2.name, report[1])
+        self.assertFalse(self.wiz_model._get_dirty_report(
+            (self.supplier_invoice_1 + self.supplier_invoice_2)._ids))
@@ -2,6 +2,8 @@
 # © 2010-2011 Ian Li <ian.li@elico-corp.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from collections import Counter
+
 from openerp import api, fields, models, _
 from openerp.exceptions import Warning as UserError
 
@@ -14,6 +16,71 @@ class InvoiceMerge(models.TransientModel):
         string='Keep references from original invoices', default=True)
     date_invoice = fields.Date('Invoice Date')
 
+    @api.model
+    def _get_dirty_check_fields(self):
+        """Return the invoice fields which must be the same on all the
+        selected invoices, with the message reported when they are not.
+        """
+        return [
+            ('account_id', _('Not all invoices use the same account!')),
+            ('company_id', _('Not all invoices are at the same company!')),
+            ('partner_id', _('Not all invoices are for the same partner!')),
+            ('type', _('Not all invoices are of the same type!')),
+            ('currency_id',
+             _('Not all invoices are at the same currency!')),
+            ('journal_id', _('Not all invoices are at the same journal!')),
+            ('partner_bank_id',
+             _('Not all invoices have the same Partner Bank Account!')),
+        ]
+
+    @api.model
+    def _get_dirty_report(self, ids):
+        """Check the invoices to merge with a single grouped query.
+        :return: list of messages, one per conflict found in the selection,
+            listing the conflicting values with their number of invoices
+        """
+        inv_model = self.env['account.invoice']
+        check_fields = self._get_dirty_check_fields()
+        columns = ', '.join('"%s"' % fname for fname, __ in check_fields)
+        # pylint: disable=sql-injection
+        self.env.cr.execute("""
+            SELECT state, {columns}, count(*),
+                CASE WHEN state != 'draft' THEN array_agg(id) END
+            FROM account_invoice
+            WHERE id IN %s
+            GROUP BY state, {columns}
+            """.format(columns=columns), (tuple(ids),))
+        rows = self.env.cr.fetchall()
+        report = []
+        other_state_ids = [
+            inv_id for row in rows if row[-1] for inv_id in row[-1]]
+        if other_state_ids:
+            invs = inv_model.browse(other_state_ids)
+            states = (invs - invs._get_draft_invoices()).mapped('state')
+            if states:
+                report.append(
+                    _('At least one of the selected invoices is %s!') %
+                    ', '.join(sorted(set(states))))
+        for index, (fname, message) in enumerate(check_fields, 1):
+            counts = Counter()
+            for row in rows:
+                counts[row[index]] += row[-2]
+            if len(counts) < 2:
+                continue
+            field = inv_model._fields[fname]
+            names = {}
+            if field.type == 'many2one':
+                names = dict(
+                    self.env[field.comodel_name].browse(
+                        [value for value in counts if value]).name_get())
+            elif field.type == 'selection':
+                names = dict(field.get_description(self.env)['selection'])
+            report.append('\n'.join(
+                [message] + ['- %s: %d' % (
+                    names.get(value, value or _('None')), count)
+                    for value, count in counts.most_common()]))
+        return report
+
     @api.model
     def _dirty_check(self):
         if self._context.get('active_model') == 'account.invoice':
@@ -22,35 +89,9 @@ class InvoiceMerge(models.TransientModel):
                 raise UserError(
                     _('Please select multiple invoice to merge in the list '
                       'view.'))
-            invs = self.env['account.invoice'].browse(ids)
-            for i, inv in enumerate(invs):
-                if not inv._get_draft_invoices():
-                    raise UserError(
-                        _('At least one of the selected invoices is %s!') %
-                        inv.state)
-                if i > 0:
-                    if inv.account_id != invs[0].account_id:
-                        raise UserError(
-                            _('Not all invoices use the same account!'))
-                    if inv.company_id != invs[0].company_id:
-                        raise UserError(
-                            _('Not all invoices are at the same company!'))
-                    if inv.partner_id != invs[0].partner_id:
-                        raise UserError(
-                            _('Not all invoices are for the same partner!'))
-                    if inv.type != invs[0].type:
-                        raise UserError(
-                            _('Not all invoices are of the same type!'))
-                    if inv.currency_id != invs[0].currency_id:
-                        raise UserError(
-                            _('Not all invoices are at the same currency!'))
-                    if inv.journal_id != invs[0].journal_id:
-                        raise UserError(
-                            _('Not all invoices are at the same journal!'))
-                    if inv.partner_bank_id != invs[0].partner_bank_id:
-                        raise UserError(
-                            _('Not all invoices have the same '
-                              'Partner Bank Account!'))
+            report = self._get_dirty_report(ids)
+            if report:
+                raise UserError('\n\n'.join(report))
 
         return {}
 
@@ -98,3 +139,25 @@ class InvoiceMerge(models.TransientModel):
             'domain': [('id', 'in', list(ids) + allinvoices.keys())],
         })
         return action
+
+    @api.multi
+    def merge_invoices_in_background(self):
+        """Queue the merge in a job processed by a scheduled action, one
+        committed group of invoices at a time.
+
+             @return: invoice merge job action
+        """
+        aw_obj = self.env['ir.actions.act_window']
+        ids = self._context.get('active_ids', [])
+        invoices = self.env['account.invoice'].browse(ids)
+        job = self.env['invoice.merge.job'].create_from_invoices(
+            invoices, keep_references=self.keep_references,
+            date_invoice=self.date_invoice)
+        action = aw_obj.for_xml_id(
+            'account_invoice_merge', 'action_invoice_merge_job')
+        action.update({
+            'res_id': job.id,
+            'view_mode': 'form,tree',
+            'views': False,
+        })
+        return action
@@ -14,28 +14,42 @@ class AccountInvoice(models.Model):
         res.append('purchase_line_id')
         return res
 
+    @api.model
+    def _merge_set_moves_invoiced(self, order_ids):
+        """Flag the stock moves of the purchase orders as invoiced with a
+        single update.
+        """
+        if not order_ids:
+            return []
+        self.env.cr.execute("""
+            UPDATE stock_move sm
+            SET invoice_state = 'invoiced',
+                write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            FROM purchase_order_line pol
+            WHERE sm.purchase_line_id = pol.id
+                AND pol.order_id IN %s
+                AND sm.invoice_state IS DISTINCT FROM 'invoiced'
+            RETURNING sm.id
+            """, (self.env.uid, tuple(order_ids)))
+        move_ids = [row[0] for row in self.env.cr.fetchall()]
+        if move_ids:
+            self._merge_recompute_stored(
+                'stock.move', move_ids, ['invoice_state'])
+        return move_ids
+
     @api.multi
-    def do_merge(self, keep_references=True, date_invoice=False):
+    def do_merge(self, keep_references=True, date_invoice=False, bulk=False,
+                 sum_taxes=False):
         invoices_info, invoice_lines_info = super(
             AccountInvoice, self).do_merge(keep_references=keep_references,
-                                           date_invoice=date_invoice)
-        po_obj = self.env['purchase.order']
-        for new_invoice_id in invoices_info:
-            todos = po_obj.search(
-                [('invoice_ids', 'in', invoices_info[new_invoice_id])])
-            todos.write({'invoice_ids': [(4, new_invoice_id)]})
-            for org_po in todos:
-                for po_line in org_po.order_line:
-                    org_ilines = po_line.mapped('invoice_lines').filtered(
-                        lambda l: l.invoice_id.id
-                        in invoices_info[new_invoice_id])
-                    invoice_line_ids = []
-                    for org_iline in org_ilines:
-                        invoice_line_ids.append(
-                            invoice_lines_info[
-                                new_invoice_id][org_iline.id])
-                    po_line.write(
-                        {'invoice_lines': [(6, 0, invoice_line_ids)]})
-                    for stock_move in po_line.move_ids:
-                        stock_move.invoice_state = 'invoiced'
+                                           date_invoice=date_invoice,
+                                           bulk=bulk, sum_taxes=sum_taxes)
+        invoice_mapping, line_mapping = self._get_merge_mappings(
+            invoices_info, invoice_lines_info)
+        order_ids = self._merge_relink_many2many(
+            'purchase.order', 'invoice_ids', invoice_mapping, replace=False)
+        self._merge_relink_many2many(
+            'purchase.order.line', 'invoice_lines', line_mapping)
+        self._merge_set_moves_invoiced(order_ids)
         return invoices_info, invoice_lines_info
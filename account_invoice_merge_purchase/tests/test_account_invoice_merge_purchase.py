@@ -172,3 +172,44 @@ class TestAccountInvoiceMergePurchase(common.TransactionCase):
         # I check if purchase order are done
         self.assertEqual(purchase_order01.state, 'done')
         self.assertEqual(purchase_order02.state, 'done')
+
+    def test_merge_relink_purchase(self):
+        purchase_order01 = self.env.ref('purchase.purchase_order_1')
+        purchase_order01.invoice_method = 'order'
+        workflow.trg_validate(self.uid, 'purchase.order',
+                              purchase_order01.id, 'purchase_confirm',
+                              self.cr)
+        purchase_order02 = purchase_order01.copy()
+        workflow.trg_validate(self.uid, 'purchase.order',
+                              purchase_order02.id, 'purchase_confirm',
+                              self.cr)
+        purchase_orders = purchase_order01 | purchase_order02
+        purchase_orders.invalidate_cache()
+        invoices = purchase_orders.mapped('invoice_ids')
+        merged_lines = invoices.mapped('invoice_line')
+        # I link an order line to an invoice which is not merged
+        other_invoice = self.inv_obj.create({
+            'journal_id': self.env.ref('account.expenses_journal').id,
+            'type': 'in_invoice',
+            'partner_id': purchase_order01.partner_id.id,
+            'account_id': self.account01.id,
+            'invoice_line': [(0, 0, {'name': 'Other', 'price_unit': 1.0})],
+        })
+        order_line = purchase_order01.order_line[0]
+        order_line.invoice_lines = [(4, other_invoice.invoice_line.id)]
+        invoices_info = invoices.do_merge()[0]
+        self.assertEqual(len(invoices_info), 1)
+        new_invoice = self.inv_obj.browse(invoices_info.keys())
+        self.env.invalidate_all()
+        # I check the orders and their lines point to the new invoice
+        for order in purchase_orders:
+            self.assertIn(new_invoice, order.invoice_ids)
+            for line in order.order_line:
+                self.assertTrue(line.invoice_lines & new_invoice.invoice_line)
+                self.assertFalse(line.invoice_lines & merged_lines)
+        self.assertIn(other_invoice.invoice_line, order_line.invoice_lines)
+        # I check the stock moves of the orders are invoiced
+        moves = purchase_orders.mapped('order_line.move_ids')
+        self.assertTrue(moves)
+        for move in moves:
+            self.assertEqual(move.invoice_state, 'invoiced')
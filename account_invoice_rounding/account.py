@@ -18,6 +18,8 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+from collections import defaultdict
+
 from openerp import models, fields, api
 from openerp.tools.float_utils import float_round, float_compare
 from openerp.tools.translate import _
@@ -28,38 +30,52 @@ import openerp.addons.decimal_precision as dp
 class AccountInvoice(models.Model):
     _inherit = "account.invoice"
 
-    def _swedish_add_invoice_line(self, cr, uid, invoice,
-                                  rounded_total, delta, context=None):
-        """ Create a invoice_line with the diff of rounding """
-
-        invoice_line_obj = self.pool.get('account.invoice.line')
-        obj_precision = self.pool.get('decimal.precision')
-        prec = obj_precision.precision_get(cr, uid, 'Account')
-
-        company = invoice.company_id
-        if not invoice.global_round_line_id.id:
-            new_invoice_line = {
-                'name': _('Rounding'),
-                'price_unit': -delta,
-                'account_id': company.tax_calculation_rounding_account_id.id,
-                'invoice_id': invoice.id,
-                'is_rounding': True,
-            }
-            invoice_line_obj.create(cr, uid, new_invoice_line, context=context)
-        elif float_compare(invoice.global_round_line_id.price_unit, -delta,
-                           precision_digits=prec) != 0:
-            invoice.global_round_line_id.write({'price_unit': -delta})
-
-        amount_untaxed = float_round(invoice.amount_untaxed - delta,
+    @api.multi
+    def _swedish_add_invoice_line(self, rounding, amounts, rounded_total,
+                                  delta, prec, adjustments):
+        """ Round by an invoice_line with the diff of rounding
+        The line is created or updated by _apply_swedish_rounding
+        """
+        self.ensure_one()
+        adjustments['lines'][self.id] = (-delta, rounding[2].id)
+
+        amount_untaxed = float_round(amounts['amount_untaxed'] - delta,
                                      precision_digits=prec)
         return {'amount_total': rounded_total,
                 'amount_untaxed': amount_untaxed}
 
+    @api.multi
+    def _get_invoice_tax_counts(self):
+        """ Count the taxes (not included in price) of the lines of the
+        invoices with one grouped query
+        :return dict: {invoice id: number of taxes}
+        """
+        cr = self.env.cr
+        tax_counts = dict.fromkeys(self.ids, 0)
+        for sub_ids in cr.split_for_in_conditions(self.ids):
+            cr.execute("""
+                SELECT l.invoice_id, count(DISTINCT rel.tax_id)
+                FROM account_invoice_line l
+                JOIN account_invoice_line_tax rel
+                    ON rel.invoice_line_id = l.id
+                JOIN account_tax t ON t.id = rel.tax_id
+                WHERE l.invoice_id IN %s
+                    AND NOT coalesce(t.price_include, false)
+                GROUP BY l.invoice_id
+                """, (sub_ids,))
+            tax_counts.update(cr.fetchall())
+        return tax_counts
+
     @staticmethod
-    def _all_invoice_tax_line_computed(invoice):
+    def _all_invoice_tax_line_computed(invoice, tax_counts=None):
         """ Check if all taxes have been computed on invoice lines
+        :param tax_counts: number of taxes of the lines per invoice, as
+            returned by _get_invoice_tax_counts. The taxes of the lines are
+            browsed for the invoices missing there (e.g. new records).
         :return boolean True if all tax were computed
         """
+        if tax_counts and invoice.id in tax_counts:
+            return tax_counts[invoice.id] == len(invoice.tax_line)
         tax_ids = set()
         for line in invoice.invoice_line:
             # invoice_line_tax_id is a many2many if you wonder about it
@@ -69,120 +85,276 @@ class AccountInvoice(models.Model):
         computed_tax_ids = [tax.id for tax in invoice.tax_line]
         return len(tax_ids) == len(computed_tax_ids)
 
-    def _swedish_round_globally(self, cr, uid, invoice,
-                                rounded_total, delta, context=None):
+    @api.multi
+    def _swedish_round_globally(self, rounding, amounts, rounded_total,
+                                delta, prec, adjustments, tax_counts=None):
         """ Add the diff to the biggest tax line
         This ajustment must be done only after all tax are computed
+        The tax line is written by _apply_swedish_rounding
         """
+        self.ensure_one()
         # Here we identify that all taxe lines have been computed
-        if not self._all_invoice_tax_line_computed(invoice):
+        if not self._all_invoice_tax_line_computed(self, tax_counts):
             return {}
 
-        obj_precision = self.pool.get('decimal.precision')
-        prec = obj_precision.precision_get(cr, uid, 'Account')
-        inv_tax_obj = self.pool.get('account.invoice.tax')
-
         ajust_line = None
-        for tax_line in invoice.tax_line:
+        for tax_line in self.tax_line:
             if not ajust_line or tax_line.amount > ajust_line.amount:
                 ajust_line = tax_line
         if ajust_line:
-            amount = ajust_line.amount - delta
-            vals = inv_tax_obj.amount_change(
-                cr, uid, [ajust_line.id],
-                amount,
-                currency_id=invoice.currency_id.id,
-                company_id=invoice.company_id.id,
-                date_invoice=invoice.date_invoice)['value']
-            ajust_line.write({'amount': amount,
-                              'tax_amount': vals['tax_amount']})
+            adjustments['taxes'][ajust_line.id] = ajust_line.amount - delta
 
-            amount_tax = float_round(invoice.amount_tax - delta,
+            amount_tax = float_round(amounts['amount_tax'] - delta,
                                      precision_digits=prec)
             return {'amount_total': rounded_total,
                     'amount_tax': amount_tax}
         return {}
 
-    def _compute_swedish_rounding(self, cr, uid, invoice, context=None):
+    @api.multi
+    def _get_swedish_rounding_settings(self):
+        """ Return the rounding settings of the invoices, read once per
+        company
+        :return dict: {invoice id: (rounding method, rounding precision,
+            rounding account)}
         """
-        Depending on the method defined, we add an invoice line or adapt the
-        tax lines to have a rounded total amount on the invoice
-        :param invoice: invoice browse record
-        :return dict: updated values for _amount_all
+        by_company = {}
+        settings = {}
+        for invoice in self:
+            company = invoice.company_id
+            if company.id not in by_company:
+                by_company[company.id] = (
+                    company.tax_calculation_rounding_method,
+                    company.tax_calculation_rounding,
+                    company.tax_calculation_rounding_account_id)
+            settings[invoice.id] = by_company[company.id]
+        return settings
+
+    @api.multi
+    def _get_swedish_rounded_invoices(self):
+        """ Return the invoices to which swedish rounding applies """
+        return self.filtered(
+            lambda i: i.type in ('out_invoice', 'out_refund') or
+            (i.enable_rounding_for_supplier and
+             i.type in ('in_invoice', 'in_refund')))
+
+    @api.multi
+    def _get_amounts_before_rounding(self):
+        """ Return the amounts of the invoice without the rounding line and
+        the swedish rounding adjustment, summed from its lines, for the
+        rounding reconciliation
         """
-        obj_precision = self.pool.get('decimal.precision')
+        self.ensure_one()
+        amount_untaxed = sum(line.price_subtotal
+                             for line in self.invoice_line
+                             if not line.is_rounding)
+        amount_tax = sum(line.amount for line in self.tax_line)
+        return {'amount_untaxed': amount_untaxed,
+                'amount_tax': amount_tax,
+                'amount_total': amount_untaxed + amount_tax}
 
-        # avoid recusivity
-        if context and 'swedish_write' in context:
-            return {}
+    @api.multi
+    def _get_swedish_tax_counts(self, settings):
+        """ Count the taxes of the lines of the invoices rounded globally,
+        the other ones do not need it
+        """
+        invoices = self.filtered(
+            lambda i: settings[i.id][0] == 'swedish_round_globally')
+        return invoices._get_invoice_tax_counts()
 
-        company = invoice.company_id
-        round_method = company.tax_calculation_rounding_method
+    @api.multi
+    def _compute_swedish_rounding(self, rounding, amounts, prec,
+                                  adjustments, tax_counts=None):
+        """
+        Depending on the method defined, we add an invoice line or adapt the
+        tax lines to have a rounded total amount on the invoice
+        :param rounding: rounding settings of the invoice, as returned by
+            _get_swedish_rounding_settings
+        :param amounts: amounts of the invoice before rounding, as returned
+            by _get_amounts_before_rounding
+        :param adjustments: dict collecting the rounding lines and the tax
+            lines to write
+        :param tax_counts: number of taxes of the lines per invoice, as
+            returned by _get_invoice_tax_counts
+        :return dict: updated values for _compute_amount
+        """
+        self.ensure_one()
+        round_method, rounding_prec = rounding[:2]
 
-        if round_method[:7] != 'swedish':
+        if not round_method or round_method[:7] != 'swedish':
             return {}
 
-        prec = obj_precision.precision_get(cr, uid, 'Account')
-        rounding_prec = company.tax_calculation_rounding
         if rounding_prec <= 0.00:
             return {}
-        rounded_total = float_round(invoice.amount_total,
+        amount_total = amounts['amount_total']
+        rounded_total = float_round(amount_total,
                                     precision_rounding=rounding_prec)
 
-        if float_compare(rounded_total, invoice.amount_total,
+        if float_compare(rounded_total, amount_total,
                          precision_digits=prec) == 0:
             return {}
 
-        # To avoid recursivity as we need to write on invoice or
-        # on objects triggering computation of _amount_all
-        ctx = context.copy()
-        ctx['swedish_write'] = True
-
-        delta = float_round(invoice.amount_total - rounded_total,
+        delta = float_round(amount_total - rounded_total,
                             precision_digits=prec)
         if round_method == 'swedish_add_invoice_line':
-            return self._swedish_add_invoice_line(cr, uid, invoice,
-                                                  rounded_total, delta,
-                                                  context=ctx)
+            return self._swedish_add_invoice_line(
+                rounding, amounts, rounded_total, delta, prec, adjustments)
         elif round_method == 'swedish_round_globally':
-            return self._swedish_round_globally(cr, uid, invoice,
-                                                rounded_total, delta,
-                                                context=ctx)
+            return self._swedish_round_globally(
+                rounding, amounts, rounded_total, delta, prec, adjustments,
+                tax_counts=tax_counts)
         return {}
 
-    @api.one
+    @api.model
+    def _apply_swedish_rounding(self, adjustments, prec):
+        """ Create or update the rounding lines and adjust the tax lines
+        collected by _compute_swedish_rounding, in one pass
+        Rounding lines getting the same amount are updated at once.
+        """
+        # To avoid recursivity as we write on objects triggering
+        # the rounding reconciliation
+        ctx = dict(self.env.context, swedish_write=True)
+        invoice_line_model = self.env['account.invoice.line'].with_context(
+            ctx)
+        lines_by_price = defaultdict(list)
+        for invoice_id, (price_unit, account_id) in \
+                adjustments['lines'].iteritems():
+            line = self.browse(invoice_id).global_round_line_id
+            if line:
+                if float_compare(line.price_unit, price_unit,
+                                 precision_digits=prec) != 0:
+                    lines_by_price[price_unit].append(line.id)
+            else:
+                invoice_line_model.create({
+                    'name': _('Rounding'),
+                    'price_unit': price_unit,
+                    'account_id': account_id,
+                    'invoice_id': invoice_id,
+                    'is_rounding': True,
+                })
+        for price_unit, line_ids in lines_by_price.iteritems():
+            invoice_line_model.browse(line_ids).write(
+                {'price_unit': price_unit})
+
+        inv_tax_model = self.env['account.invoice.tax'].with_context(ctx)
+        for tax_line_id, amount in adjustments['taxes'].iteritems():
+            tax_line = inv_tax_model.browse(tax_line_id)
+            invoice = tax_line.invoice_id
+            vals = tax_line.amount_change(
+                amount,
+                currency_id=invoice.currency_id.id,
+                company_id=invoice.company_id.id,
+                date_invoice=invoice.date_invoice)['value']
+            tax_line.write({'amount': amount,
+                            'tax_amount': vals['tax_amount']})
+
+    @api.multi
+    def _reconcile_swedish_rounding(self):
+        """ Rounding reconciliation stage, run once the amounts of the
+        invoices are recomputed: create or update the rounding lines and
+        adjust the tax lines of all the invoices in one pass
+        """
+        # the caller reconciles once its writes are done
+        if 'swedish_write' in self.env.context:
+            return
+        invoices = self.exists()._get_swedish_rounded_invoices()
+        if not invoices:
+            return
+        prec = self.env['decimal.precision'].precision_get('Account')
+        settings = invoices._get_swedish_rounding_settings()
+        tax_counts = invoices._get_swedish_tax_counts(settings)
+        adjustments = {'lines': {}, 'taxes': {}}
+        for invoice in invoices:
+            invoice._compute_swedish_rounding(
+                settings[invoice.id], invoice._get_amounts_before_rounding(),
+                prec, adjustments, tax_counts=tax_counts)
+        if adjustments['lines'] or adjustments['taxes']:
+            self._apply_swedish_rounding(adjustments, prec)
+
+    @api.multi
     @api.depends('invoice_line.price_subtotal', 'tax_line.amount')
     def _compute_amount(self):
         """ Add swedish rounding computing
         Makes sure invoice line for rounding is not computed in totals
+        The amounts are computed as if the rounding line and the tax line
+        adjustment were already written: writing them is left to
+        _reconcile_swedish_rounding, so that the computation has no side
+        effect.
         """
         super(AccountInvoice, self)._compute_amount()
-        if self.type in ('out_invoice', 'out_refund')\
-            or (self.enable_rounding_for_supplier and
-                self.type in ('in_invoice', 'in_refund')):
-            if self.global_round_line_id.id:
-                line = self.global_round_line_id
-                if line:
-                    self.amount_untaxed -= line.price_subtotal
-            self.amount_total = self.amount_tax + self.amount_untaxed
-            swedish_rounding = self._compute_swedish_rounding(
-                self, context=self.env.context)
-            if swedish_rounding:
-                self.amount_total = swedish_rounding['amount_total']
-                if 'amount_tax' in swedish_rounding:
-                    self.amount_tax = swedish_rounding['amount_tax']
-                elif 'amount_untaxed' in swedish_rounding:
-                    self.amount_untaxed = (
-                        swedish_rounding['amount_untaxed'])
+        invoices = self._get_swedish_rounded_invoices()
+        if not invoices:
+            return
+        prec = self.env['decimal.precision'].precision_get('Account')
+        settings = invoices._get_swedish_rounding_settings()
+        tax_counts = invoices._get_swedish_tax_counts(settings)
+        for invoice in invoices:
+            # start from the amounts computed by super, without the
+            # rounding line
+            amount_untaxed = float_round(
+                invoice.amount_untaxed -
+                invoice.global_round_line_id.price_subtotal,
+                precision_digits=prec)
+            amounts = {'amount_untaxed': amount_untaxed,
+                       'amount_tax': invoice.amount_tax,
+                       'amount_total': amount_untaxed + invoice.amount_tax}
+            amounts.update(invoice._compute_swedish_rounding(
+                settings[invoice.id], amounts, prec,
+                {'lines': {}, 'taxes': {}}, tax_counts=tax_counts))
+            invoice.amount_untaxed = amounts['amount_untaxed']
+            invoice.amount_tax = amounts['amount_tax']
+            invoice.amount_total = amounts['amount_total']
+
+    @api.model
+    def create(self, vals):
+        invoice = super(AccountInvoice, self.with_context(
+            swedish_write=True)).create(vals)
+        invoice = invoice.with_context(self.env.context)
+        invoice._reconcile_swedish_rounding()
+        return invoice
+
+    @api.multi
+    def write(self, vals):
+        if not set(vals) & set(self._get_swedish_rounding_fields()):
+            return super(AccountInvoice, self).write(vals)
+        res = super(AccountInvoice, self.with_context(
+            swedish_write=True)).write(vals)
+        self._reconcile_swedish_rounding()
+        return res
+
+    @api.model
+    def _get_swedish_rounding_fields(self):
+        """ Fields of the invoice whose update requires a rounding
+        reconciliation
+        """
+        return ['invoice_line', 'tax_line', 'type', 'currency_id',
+                'company_id', 'enable_rounding_for_supplier']
+
+    @api.multi
+    def button_reset_taxes(self):
+        res = super(AccountInvoice, self.with_context(
+            swedish_write=True)).button_reset_taxes()
+        self._reconcile_swedish_rounding()
+        return res
 
     @api.multi
     def _get_rounding_invoice_line_id(self):
+        """ Fetch the rounding lines of all the invoices at once, using the
+        partial index on rounding lines
+        """
+        cr = self.env.cr
+        line_ids = {}
+        for sub_ids in cr.split_for_in_conditions(self.ids):
+            cr.execute("""
+                SELECT invoice_id, min(id)
+                FROM account_invoice_line
+                WHERE is_rounding AND invoice_id IN %s
+                GROUP BY invoice_id
+                """, (sub_ids,))
+            line_ids.update(cr.fetchall())
         invoice_line_model = self.env['account.invoice.line']
         for invoice in self:
-            lines = invoice_line_model.search(
-                [('invoice_id', '=', invoice.id),
-                 ('is_rounding', '=', True)])
-            invoice.global_round_line_id = lines
+            invoice.global_round_line_id = invoice_line_model.browse(
+                line_ids.get(invoice.id))
 
     @api.multi
     def onchange_partner_id(self, type, partner_id, date_invoice=False,
@@ -229,37 +401,89 @@ class AccountInvoiceLine(models.Model):
 
     is_rounding = fields.Boolean('Rounding Line')
 
+    @api.model
+    def create(self, vals):
+        line = super(AccountInvoiceLine, self).create(vals)
+        line.invoice_id._reconcile_swedish_rounding()
+        return line
+
+    @api.multi
+    def write(self, vals):
+        invoices = self.mapped('invoice_id')
+        res = super(AccountInvoiceLine, self).write(vals)
+        (invoices | self.mapped('invoice_id'))._reconcile_swedish_rounding()
+        return res
+
+    @api.multi
+    def unlink(self):
+        invoices = self.mapped('invoice_id')
+        res = super(AccountInvoiceLine, self).unlink()
+        invoices._reconcile_swedish_rounding()
+        return res
+
+    def _auto_init(self, cr, context=None):
+        res = super(AccountInvoiceLine, self)._auto_init(cr, context=context)
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = %s",
+                   ('account_invoice_line_rounding_index',))
+        if not cr.fetchone():
+            cr.execute("""
+                CREATE INDEX account_invoice_line_rounding_index
+                ON account_invoice_line (invoice_id) WHERE is_rounding
+                """)
+        return res
+
+
+class AccountInvoiceTax(models.Model):
+    _inherit = 'account.invoice.tax'
+
+    @api.model
+    def create(self, vals):
+        tax_line = super(AccountInvoiceTax, self).create(vals)
+        tax_line.invoice_id._reconcile_swedish_rounding()
+        return tax_line
+
+    @api.multi
+    def write(self, vals):
+        invoices = self.mapped('invoice_id')
+        res = super(AccountInvoiceTax, self).write(vals)
+        (invoices | self.mapped('invoice_id'))._reconcile_swedish_rounding()
+        return res
+
+    @api.multi
+    def unlink(self):
+        invoices = self.mapped('invoice_id')
+        res = super(AccountInvoiceTax, self).unlink()
+        invoices._reconcile_swedish_rounding()
+        return res
+
 
 class AccountTax(models.Model):
     _inherit = 'account.tax'
 
-    def compute_inv(self, cr, uid, taxes, price_unit, quantity,
-                    product=None, partner=None, precision=None):
+    def _get_tax_compute_precision(self, cr, uid, taxes, precision):
         """
         Using swedish rounding we want to keep standard global precision
         so we add precision to do global computation
+        The swedish rounding of the company is read from a cache.
         """
-        if taxes and taxes[0].company_id.tax_calculation_rounding_method[:7] \
-                == 'swedish':
+        if taxes and self.pool['res.company']._is_swedish_rounding(
+                cr, uid, taxes[0].company_id.id):
             if not precision:
                 precision = self.pool['decimal.precision'].precision_get(
                     cr, uid, 'Account')
             precision += 5
+        return precision
+
+    def compute_inv(self, cr, uid, taxes, price_unit, quantity,
+                    product=None, partner=None, precision=None):
+        precision = self._get_tax_compute_precision(cr, uid, taxes, precision)
         return super(AccountTax, self).compute_inv(
             cr, uid, taxes, price_unit, quantity, product=product,
             partner=partner, precision=precision)
 
     def _compute(self, cr, uid, taxes, price_unit, quantity,
                  product=None, partner=None, precision=None):
-        """Using swedish rounding we want to keep standard global precision
-        so we add precision to do global computation
-        """
-        if taxes and taxes[0].company_id.tax_calculation_rounding_method[:7] \
-                == 'swedish':
-            if not precision:
-                precision = self.pool['decimal.precision'].precision_get(
-                    cr, uid, 'Account')
-            precision += 5
+        precision = self._get_tax_compute_precision(cr, uid, taxes, precision)
         return super(AccountTax, self)._compute(
             cr, uid, taxes, price_unit, quantity, product=product,
             partner=partner, precision=precision)
@@ -18,7 +18,7 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
-from openerp import models, fields
+from openerp import SUPERUSER_ID, api, models, fields, tools
 
 
 class ResCompany(models.Model):
@@ -47,3 +47,20 @@ class ResCompany(models.Model):
              "choose 'Round per line' because you certainly want the sum "
              "of your tax-included line subtotals to be equal to the "
              "total amount with taxes.")
+
+    @tools.ormcache(skiparg=3)
+    def _is_swedish_rounding(self, cr, uid, company_id):
+        """ Return whether the company uses a swedish rounding method, cached
+        until the rounding method of a company changes
+        """
+        method = self.read(
+            cr, SUPERUSER_ID, [company_id],
+            ['tax_calculation_rounding_method'],
+        )[0]['tax_calculation_rounding_method']
+        return bool(method) and method[:7] == 'swedish'
+
+    @api.multi
+    def write(self, vals):
+        if 'tax_calculation_rounding_method' in vals:
+            self.clear_caches()
+        return super(ResCompany, self).write(vals)
@@ -1 +1,2 @@
-from . import test_invoice_rounding
\ No newline at end of file
+from . import test_invoice_rounding
+from . import test_invoice_rounding_benchmark
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+"""Benchmark of the swedish rounding methods
+
+Synthetic invoices are created, one of their lines is updated and they are
+validated, recording the number of queries and the wall time of each step.
+Each swedish rounding method is compared with a reference run of the same
+invoices rounded per line: the test fails when the rounding takes more
+queries per invoice line than the reference, or more than a small constant
+number of queries per invoice, or when it exceeds a recorded baseline.
+
+The benchmark runs with the tests of the module and is driven by environment
+variables:
+
+* ``INVOICE_ROUNDING_BENCHMARK_SIZES``: comma separated numbers of invoice
+  lines (default ``1,10,100``), e.g. ``1,100,1000,5000``
+* ``INVOICE_ROUNDING_BENCHMARK_BASELINE``: JSON file of query counts, as
+  written with ``INVOICE_ROUNDING_BENCHMARK_RECORD``, to compare with
+* ``INVOICE_ROUNDING_BENCHMARK_RECORD``: JSON file where the measures are
+  written
+* ``INVOICE_ROUNDING_BENCHMARK_TOLERANCE``: allowed increase of the query
+  counts over the baseline (default ``0.1``, i.e. 10%)
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from openerp.tools.float_utils import float_compare, float_round
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_SIZES = [
+    int(size) for size in os.environ.get(
+        'INVOICE_ROUNDING_BENCHMARK_SIZES', '1,10,100').split(',')]
+BENCHMARK_BASELINE = os.environ.get('INVOICE_ROUNDING_BENCHMARK_BASELINE')
+BENCHMARK_RECORD = os.environ.get('INVOICE_ROUNDING_BENCHMARK_RECORD')
+BENCHMARK_TOLERANCE = float(
+    os.environ.get('INVOICE_ROUNDING_BENCHMARK_TOLERANCE', '0.1'))
+
+# reference rounding method the swedish rounding methods are compared with
+REFERENCE_METHOD = 'round_per_line'
+# queries allowed over the reference for each invoice line
+MAX_EXTRA_QUERIES_PER_LINE = {
+    'create': 1,
+    'validate': 1,
+}
+# queries allowed over the reference for each invoice, whatever its size:
+# reading the settings, counting the taxes, writing the rounding line or
+# adjusting a tax line
+MAX_EXTRA_QUERIES = {
+    'create': 60,
+    'validate': 60,
+}
+# queries allowed for each 1000 lines of the invoice when updating one line
+MAX_WRITE_QUERIES_PER_1000_LINES = 20
+
+ROUNDING = 0.05
+
+
+class RoundingBenchmarkMixin(object):
+    """Benchmark of the swedish rounding, to mix with a TransactionCase"""
+
+    def _setup_benchmark_data(self):
+        self.company = self.env.ref('base.main_company')
+        self.journal_sale = self.env['account.journal'].create({
+            'name': 'Benchmark sale journal',
+            'type': 'sale',
+            'code': 'BENCH',
+        })
+        self.account = self.env['account.account'].create({
+            'name': 'Benchmark account',
+            'code': 'BENCH',
+            'user_type': self.env.ref(
+                'account.data_account_type_expense').id,
+        })
+        self.taxes = self.env['account.tax']
+        for amount in (0.025, 0.077, 0.1, 0.2):
+            tax_code = self.env['account.tax.code'].create({
+                'name': 'Benchmark tax %s' % amount,
+                'sign': 1,
+            })
+            self.taxes |= self.env['account.tax'].create({
+                'name': 'Benchmark tax %s' % amount,
+                'type': 'percent',
+                'amount': amount,
+                'type_tax_use': 'sale',
+                'tax_code_id': tax_code.id,
+            })
+        self.partner = self.env['res.partner'].create({
+            'name': 'Benchmark partner',
+        })
+        self.product = self.env['product.product'].create({
+            'name': 'Benchmark product',
+        })
+
+    def _prepare_benchmark_invoice(self, line_count, currency):
+        lines = []
+        for index in range(line_count):
+            # mixed taxes, some lines without tax
+            taxes = self.taxes[index % (len(self.taxes) + 1):][:1]
+            lines.append((0, 0, {
+                'name': 'Benchmark line %s' % index,
+                'product_id': self.product.id,
+                'account_id': self.account.id,
+                'invoice_line_tax_id': [(6, 0, taxes.ids)],
+                'quantity': 1 + index % 3,
+                'price_unit': 9.99 + (index % 7) * 1.13,
+            }))
+        return {
+            'partner_id': self.partner.id,
+            'currency_id': currency.id,
+            'account_id': self.account.id,
+            'journal_id': self.journal_sale.id,
+            'date_invoice': '2018-01-01',
+            'invoice_line': lines,
+        }
+
+    @contextmanager
+    def _measure(self, measures, operation):
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        start = time.time()
+        yield
+        measures[operation] = {
+            'queries': cr.sql_log_count - queries,
+            'time': time.time() - start,
+        }
+
+    def _benchmark_invoice(self, line_count, currency, rounded=True):
+        """Create, update and validate an invoice of ``line_count`` lines
+        :param rounded: check that the total of the invoice is rounded
+        :return: dict {operation: {'queries': count, 'time': seconds}}
+        """
+        measures = {}
+        vals = self._prepare_benchmark_invoice(line_count, currency)
+        with self._measure(measures, 'create'):
+            invoice = self.env['account.invoice'].create(vals)
+            invoice.button_reset_taxes()
+        line = invoice.invoice_line.filtered(lambda l: not l.is_rounding)[0]
+        with self._measure(measures, 'write_line'):
+            line.price_unit += 0.01
+        with self._measure(measures, 'validate'):
+            invoice.signal_workflow('invoice_open')
+        self.assertEqual(invoice.state, 'open')
+        if not rounded:
+            return measures
+        self.assertEqual(
+            float_compare(invoice.amount_total,
+                          float_round(invoice.amount_total,
+                                      precision_rounding=ROUNDING),
+                          precision_digits=2), 0,
+            "Total %s is not rounded" % invoice.amount_total)
+        return measures
+
+    def _set_rounding_method(self, method, currency):
+        """Round the invoices in ``currency`` with ``method``"""
+        self.company.write({
+            'tax_calculation_rounding_method': method,
+            'tax_calculation_rounding': ROUNDING,
+            'tax_calculation_rounding_account_id': self.account.id,
+        })
+
+    def _run_scenario(self, method, currency):
+        """Benchmark the invoices of all the sizes with ``method``
+        :return: (scenario name, {line count: measures})
+        """
+        scenario = '%s/%s' % (method, currency.name)
+        self._set_rounding_method(method, currency)
+        results = {}
+        for line_count in sorted(BENCHMARK_SIZES):
+            results[line_count] = self._benchmark_invoice(
+                line_count, currency, rounded=method != REFERENCE_METHOD)
+            for operation, measure in sorted(
+                    results[line_count].iteritems()):
+                _logger.info(
+                    "Rounding benchmark %s, %d lines, %s: %d queries, %.3fs",
+                    scenario, line_count, operation, measure['queries'],
+                    measure['time'])
+        self._record_benchmark(scenario, results)
+        return scenario, results
+
+    def _run_benchmark(self, method, currency=None):
+        """Benchmark the rounding ``method`` on invoices in ``currency``,
+        the company currency by default, against the reference method
+        """
+        currency = currency or self.company.currency_id
+        reference_scenario, reference = self._run_scenario(
+            REFERENCE_METHOD, currency)
+        scenario, results = self._run_scenario(method, currency)
+        self._check_benchmark(reference_scenario, reference)
+        self._check_benchmark(scenario, results, reference=reference)
+
+    def _get_benchmark_key(self, scenario, line_count, operation):
+        return '%s/%d/%s' % (scenario, line_count, operation)
+
+    def _record_benchmark(self, scenario, results):
+        if not BENCHMARK_RECORD:
+            return
+        records = {}
+        if os.path.exists(BENCHMARK_RECORD):
+            with open(BENCHMARK_RECORD) as record_file:
+                records = json.load(record_file)
+        for line_count, measures in results.iteritems():
+            for operation, measure in measures.iteritems():
+                records[self._get_benchmark_key(
+                    scenario, line_count, operation)] = measure
+        with open(BENCHMARK_RECORD, 'w') as record_file:
+            json.dump(records, record_file, indent=2, sort_keys=True)
+
+    def _check_benchmark(self, scenario, results, reference=None):
+        """Check the query counts of a scenario
+        :param reference: results of the reference scenario, to compare
+            the create and validate query counts with
+        """
+        sizes = sorted(results)
+        smallest = results[sizes[0]]
+        # the rounding only adds a few queries to create and validate,
+        # not depending on the number of lines
+        for line_count in reference and sizes or []:
+            measures = results[line_count]
+            for operation, per_line in \
+                    MAX_EXTRA_QUERIES_PER_LINE.iteritems():
+                queries = reference[line_count][operation]['queries']
+                budget = queries + MAX_EXTRA_QUERIES[operation] + \
+                    per_line * line_count
+                self.assertLessEqual(
+                    measures[operation]['queries'], budget,
+                    "%s: %s of %d lines takes %d queries, more than %d "
+                    "(%d for %s)" % (
+                        scenario, operation, line_count,
+                        measures[operation]['queries'], budget, queries,
+                        REFERENCE_METHOD))
+        for line_count in sizes[1:]:
+            measures = results[line_count]
+            # updating one line does not depend on the number of lines
+            budget = smallest['write_line']['queries'] * \
+                (1 + BENCHMARK_TOLERANCE) + \
+                MAX_WRITE_QUERIES_PER_1000_LINES * (line_count // 1000 + 1)
+            self.assertLessEqual(
+                measures['write_line']['queries'], budget,
+                "%s: updating a line of %d lines takes %d queries, more "
+                "than %d" % (scenario, line_count,
+                             measures['write_line']['queries'], budget))
+        if not BENCHMARK_BASELINE:
+            return
+        with open(BENCHMARK_BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        for line_count, measures in results.iteritems():
+            for operation, measure in measures.iteritems():
+                key = self._get_benchmark_key(
+                    scenario, line_count, operation)
+                if key not in baseline:
+                    continue
+                budget = baseline[key]['queries'] * (1 + BENCHMARK_TOLERANCE)
+                self.assertLessEqual(
+                    measure['queries'], budget,
+                    "%s: %d queries, baseline is %d" % (
+                        key, measure['queries'], baseline[key]['queries']))
@@ -184,3 +184,75 @@ class TestSwedishRounding(test_common.TransactionCase):
         invoice3.signal_workflow('invoice_open')
         self.assertEqual(invoice3.amount_total, 96.95)
         self.assertEqual(invoice3.amount_untaxed, 90.02)
+
+    def test_rounding_batch(self):
+        company = self.env.ref('base.main_company')
+        company.write({
+            'tax_calculation_rounding_method': 'swedish_add_invoice_line',
+            'tax_calculation_rounding': 0.05,
+            'tax_calculation_rounding_account_id': self.account.id
+        })
+        invoices = (self.create_dummy_invoice() +
+                    self.create_two_lines_dummy_invoice() +
+                    self.create_dummy_invoice_2())
+        invoices.button_reset_taxes()
+        # recompute the totals of all the invoices at once
+        self.env.add_todo(invoices._fields['amount_total'], invoices)
+        invoices.recompute()
+        self.assertEqual(invoices.mapped('amount_total'), [110, 134, 96.95])
+        rounding_lines = invoices.mapped('invoice_line').filtered(
+            lambda l: l.is_rounding)
+        self.assertEqual(len(rounding_lines), 3)
+        self.assertEqual(rounding_lines.mapped('invoice_id'), invoices)
+        self.env.invalidate_all()
+        self.assertEqual(invoices.mapped('global_round_line_id'),
+                         rounding_lines)
+
+    def test_rounding_reconciliation(self):
+        company = self.env.ref('base.main_company')
+        company.write({
+            'tax_calculation_rounding_method': 'swedish_add_invoice_line',
+            'tax_calculation_rounding': 0.05,
+            'tax_calculation_rounding_account_id': self.account.id
+        })
+        invoice = self.create_dummy_invoice()
+        invoice.button_reset_taxes()
+        # without reconciliation, the amounts are still rounded but the
+        # rounding line is not created again
+        invoice.global_round_line_id.with_context(
+            swedish_write=True).unlink()
+        self.assertFalse(invoice.global_round_line_id)
+        self.assertEqual(invoice.amount_total, 110)
+        self.assertEqual(invoice.amount_untaxed, 100)
+        invoice._reconcile_swedish_rounding()
+        invoice._reconcile_swedish_rounding()
+        self.assertEqual(len(invoice.invoice_line), 2)
+        self.assertEqual(invoice.global_round_line_id.price_subtotal, 0.01)
+        self.assertEqual(invoice.amount_total, 110)
+        self.assertEqual(invoice.amount_untaxed, 100)
+
+    def test_tax_compute_precision(self):
+        company = self.env.ref('base.main_company')
+        company.write({
+            'tax_calculation_rounding_method': 'round_per_line',
+        })
+        tax_model = self.registry('account.tax')
+        self.assertEqual(tax_model._get_tax_compute_precision(
+            self.cr, self.uid, self.tax_10, 2), 2)
+        company.write({
+            'tax_calculation_rounding_method': 'swedish_round_globally',
+            'tax_calculation_rounding': 0.05,
+        })
+        self.assertEqual(tax_model._get_tax_compute_precision(
+            self.cr, self.uid, self.tax_10, 2), 7)
+
+    def test_tax_line_computed(self):
+        invoice = self.create_two_lines_dummy_invoice()
+        invoice_model = self.env['account.invoice']
+        self.assertEqual(invoice._get_invoice_tax_counts(), {invoice.id: 2})
+        self.assertFalse(invoice_model._all_invoice_tax_line_computed(
+            invoice, invoice._get_invoice_tax_counts()))
+        invoice.button_reset_taxes()
+        self.assertTrue(invoice_model._all_invoice_tax_line_computed(
+            invoice, invoice._get_invoice_tax_counts()))
+        self.assertTrue(invoice_model._all_invoice_tax_line_computed(invoice))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)
+import openerp.tests.common as test_common
+
+from .benchmark import RoundingBenchmarkMixin
+
+
+class TestSwedishRoundingBenchmark(RoundingBenchmarkMixin,
+                                   test_common.TransactionCase):
+
+    def setUp(self):
+        super(TestSwedishRoundingBenchmark, self).setUp()
+        self._setup_benchmark_data()
+
+    def test_benchmark_round_globally(self):
+        self._run_benchmark('swedish_round_globally')
+
+    def test_benchmark_add_invoice_line(self):
+        self._run_benchmark('swedish_add_invoice_line')
@@ -1,44 +1,33 @@
 # -*- coding: utf-8 -*-
 # Copyright 2015 Alessio Gerace <alessio.gerace@agilebg.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from openerp import models
+from openerp import api, models
 
 
 class AccountInvoice(models.Model):
     _inherit = "account.invoice"
 
-    def _compute_swedish_rounding(self, cr, uid, invoice, context=None):
+    @api.multi
+    def _get_swedish_rounding_settings(self):
         """
-        Depending on the method defined, we add an invoice line or adapt the
-        tax lines to have a rounded total amount on the invoice
-        :param invoice: invoice browse record
-        :return dict: updated values for _amount_all
+        Invoices in a foreign currency are rounded with the rounding rule
+        of their currency, and not rounded without such a rule.
+        :return dict: {invoice id: (rounding method, rounding precision,
+            rounding account)}
         """
-        # avoid recusivity
-
-        if 'swedish_write' in context:
-            return {}
-        rounding_rule_model = self.pool.get('company.rounding')
-        company = invoice.company_id
-        if invoice.currency_id.id != company.currency_id.id:
-            ret_ids = rounding_rule_model.search(
-                cr, uid,
-                [
-                    ('company_id', '=', company.id),
-                    ('currency_id', '=', invoice.currency_id.id),
-                ],
-                context=context)
-            if ret_ids:
-                rule = rounding_rule_model.browse(
-                    cr, uid, ret_ids[0], context=context)
-                company.tax_calculation_rounding_method = (
-                    rule.tax_calculation_rounding_method)
-                company.tax_calculation_rounding = (
-                    rule.tax_calculation_rounding)
-                company.tax_calculation_rounding_account_id = (
-                    rule.tax_calculation_rounding_account_id)
+        settings = super(AccountInvoice, self)._get_swedish_rounding_settings()
+        rounding_rule_model = self.env['company.rounding']
+        account_model = self.env['account.account']
+        for invoice in self:
+            company = invoice.company_id
+            if invoice.currency_id == company.currency_id:
+                continue
+            rule = rounding_rule_model._get_rounding_settings(
+                company.id, invoice.currency_id.id)
+            if rule:
+                method, rounding, account_id = rule
+                settings[invoice.id] = (method, rounding,
+                                        account_model.browse(account_id))
             else:
-                return {}
-
-        return super(AccountInvoice, self)._compute_swedish_rounding(
-            cr, uid, invoice, context=context)
+                settings[invoice.id] = (False, 0.0, account_model)
+        return settings
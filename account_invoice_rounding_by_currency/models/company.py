@@ -2,7 +2,7 @@
 # Copyright 2015 Alessio Gerace <alessio.gerace@agilebg.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from openerp import models, fields
+from openerp import SUPERUSER_ID, api, models, fields, tools
 
 
 class RoundingByCurrency(models.Model):
@@ -40,6 +40,40 @@ class RoundingByCurrency(models.Model):
             'Currency must be unique per Company'),
     ]
 
+    @tools.ormcache(skiparg=3)
+    def _get_rounding_settings(self, cr, uid, company_id, currency_id):
+        """ Return the rounding settings of a currency in a company, cached
+        per registry until a rounding rule changes
+        :return tuple: (rounding method, rounding precision, rounding
+            account id), or None if the currency has no rounding rule
+        """
+        rule_ids = self.search(
+            cr, SUPERUSER_ID,
+            [('company_id', '=', company_id),
+             ('currency_id', '=', currency_id)],
+            limit=1)
+        if not rule_ids:
+            return None
+        rule = self.browse(cr, SUPERUSER_ID, rule_ids[0])
+        return (rule.tax_calculation_rounding_method,
+                rule.tax_calculation_rounding,
+                rule.tax_calculation_rounding_account_id.id)
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(RoundingByCurrency, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(RoundingByCurrency, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(RoundingByCurrency, self).unlink()
+
 
 class ResCompany(models.Model):
     _inherit = 'res.company'
@@ -3,3 +3,4 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 from . import test_rounding_by_currencies
+from . import test_rounding_by_currencies_benchmark
@@ -63,3 +63,35 @@ class TestRoundingByCurrencies(test_common.SingleTransactionCase):
         )
         self.assertEqual(invoice.state, 'open')
         self.assertEqual(invoice.amount_total, 110.50)
+
+    def test_3_rule_cache(self):
+        rule_model = self.env['company.rounding']
+        currency = self.env.ref('base.CHF')
+        rule_model.search([('company_id', '=', self.company.id),
+                           ('currency_id', '=', currency.id)]).unlink()
+        self.assertIsNone(rule_model._get_rounding_settings(
+            self.company.id, currency.id))
+        rule = rule_model.create({
+            'company_id': self.company.id,
+            'currency_id': currency.id,
+            'tax_calculation_rounding_method': 'swedish_round_globally',
+            'tax_calculation_rounding': 0.05,
+        })
+        self.assertEqual(
+            rule_model._get_rounding_settings(self.company.id, currency.id),
+            ('swedish_round_globally', 0.05, False))
+        rule.tax_calculation_rounding = 0.1
+        self.assertEqual(
+            rule_model._get_rounding_settings(self.company.id, currency.id),
+            ('swedish_round_globally', 0.1, False))
+        company_before = (self.company.tax_calculation_rounding_method,
+                          self.company.tax_calculation_rounding)
+        invoice = self.env['account.invoice'].new(
+            {'company_id': self.company.id, 'currency_id': currency.id,
+             'type': 'out_invoice'})
+        settings = invoice._get_swedish_rounding_settings()
+        self.assertEqual(settings.values()[0][:2],
+                         ('swedish_round_globally', 0.1))
+        self.assertEqual((self.company.tax_calculation_rounding_method,
+                          self.company.tax_calculation_rounding),
+                         company_before)
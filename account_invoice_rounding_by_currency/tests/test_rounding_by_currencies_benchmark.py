@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import openerp.tests.common as test_common
+from openerp.addons.account_invoice_rounding.tests.benchmark import \
+    REFERENCE_METHOD, ROUNDING, RoundingBenchmarkMixin
+
+
+class TestRoundingByCurrenciesBenchmark(RoundingBenchmarkMixin,
+                                        test_common.TransactionCase):
+
+    def setUp(self):
+        super(TestRoundingByCurrenciesBenchmark, self).setUp()
+        self._setup_benchmark_data()
+        self.currency = self.env.ref('base.CHF')
+
+    def _set_rounding_method(self, method, currency):
+        """Round the invoices in the currency with a rule of the currency,
+        without swedish rounding method for the reference
+        """
+        super(TestRoundingByCurrenciesBenchmark, self)._set_rounding_method(
+            method, currency)
+        rounding_model = self.env['company.rounding']
+        rounding_model.search(
+            [('company_id', '=', self.company.id),
+             ('currency_id', '=', currency.id)]).unlink()
+        rounding_model.create({
+            'company_id': self.company.id,
+            'currency_id': currency.id,
+            'tax_calculation_rounding_method':
+                method != REFERENCE_METHOD and method,
+            'tax_calculation_rounding': ROUNDING,
+            'tax_calculation_rounding_account_id': self.account.id,
+        })
+
+    def test_benchmark_round_globally(self):
+        self._run_benchmark('swedish_round_globally', currency=self.currency)
+
+    def test_benchmark_add_invoice_line(self):
+        self._run_benchmark('swedish_add_invoice_line',
+                            currency=self.currency)
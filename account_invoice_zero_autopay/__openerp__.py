@@ -31,6 +31,7 @@
  'data': [],
  'test': ['test/account_invoice_zero_paid.yml',
           'test/account_invoice_no_zero_open.yml',
+          'test/account_invoice_zero_paid_batch.yml',
           ],
  'installable': True,
  'auto_install': False,
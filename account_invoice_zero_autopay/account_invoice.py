@@ -19,8 +19,6 @@
 #
 ##############################################################################
 
-from functools import partial
-
 from openerp.osv import orm
 from openerp.tools.float_utils import float_is_zero
 
@@ -28,22 +26,45 @@ from openerp.tools.float_utils import float_is_zero
 class account_invoice(orm.Model):
     _inherit = 'account.invoice'
 
+    def _get_zero_invoice_lines(self, cr, uid, ids, context=None):
+        """ Find the payable / receivable lines of the invoices with a zero
+        total, with one query per chunk of invoices
+
+        :return: list of lists of move line ids to reconcile, one list per
+                 invoice whose lines have a zero balance
+        """
+        dp_obj = self.pool['decimal.precision']
+        precision = dp_obj.precision_get(cr, uid, 'Account')
+        to_reconcile = []
+        for sub_ids in cr.split_for_in_conditions(ids):
+            cr.execute("""
+                SELECT inv.amount_total,
+                       sum(line.debit - line.credit),
+                       array_agg(line.id)
+                FROM account_invoice inv
+                JOIN account_move_line line
+                    ON line.move_id = inv.move_id
+                    AND line.account_id = inv.account_id
+                WHERE inv.id IN %s
+                GROUP BY inv.id, inv.amount_total
+                """, (sub_ids,))
+            for amount_total, balance, line_ids in cr.fetchall():
+                if (float_is_zero(amount_total or 0.0,
+                                  precision_digits=precision) and
+                        float_is_zero(balance or 0.0,
+                                      precision_digits=precision)):
+                    to_reconcile.append(line_ids)
+        return to_reconcile
+
     def invoice_validate(self, cr, uid, ids, context=None):
         result = super(account_invoice, self).invoice_validate(
             cr, uid, ids, context=context)
-        dp_obj = self.pool['decimal.precision']
-        precision = dp_obj.precision_get(cr, uid, 'Account')
-        is_zero = partial(float_is_zero, precision_digits=precision)
-        for invoice in self.browse(cr, uid, ids, context=context):
-            if is_zero(invoice.amount_total):
-                account = invoice.account_id.id
-                # search the payable / receivable lines
-                lines = [line for line in invoice.move_id.line_id
-                         if line.account_id.id == account]
-                # reconcile the lines with a zero balance
-                if is_zero(sum(line.debit - line.credit for line in lines)):
-                    move_line_obj = self.pool['account.move.line']
-                    move_line_obj.reconcile(cr, uid,
-                                            [line.id for line in lines],
-                                            context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        move_line_obj = self.pool['account.move.line']
+        # reconcile the lines with a zero balance, each invoice having
+        # its own reconciliation
+        for line_ids in self._get_zero_invoice_lines(cr, uid, ids,
+                                                     context=context):
+            move_line_obj.reconcile(cr, uid, line_ids, context=context)
         return result
@@ -12,6 +12,11 @@ class AccountConfigSettings(models.Model):
     reconciliation_writeoff_account = fields.Many2one('account.account',
                                                       'Write-Off account',
                                                       required=True)
+    lazy_outstanding_widget = fields.Boolean(
+        'Load outstanding payments on demand',
+        help="Only show whether an invoice has outstanding payments, and "
+             "load them when the user asks for it. Recommended for partners "
+             "with many outstanding payments.")
 
     @api.model
     def get_reconciliation_writeoff_account(self):
@@ -27,3 +32,17 @@ class AccountConfigSettings(models.Model):
                                       'reconciliation_writeoff_account',
                                       record.
                                       reconciliation_writeoff_account.id)
+
+    @api.model
+    def get_default_lazy_outstanding_widget(self, fields):
+        ir_values_obj = self.env['ir.values']
+        return {'lazy_outstanding_widget': ir_values_obj.get_default(
+            'account.config.settings', 'lazy_outstanding_widget')}
+
+    @api.multi
+    def set_lazy_outstanding_widget(self):
+        for record in self:
+            ir_values_obj = self.env['ir.values']
+            ir_values_obj.set_default('account.config.settings',
+                                      'lazy_outstanding_widget',
+                                      record.lazy_outstanding_widget)
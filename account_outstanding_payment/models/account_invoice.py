@@ -3,110 +3,288 @@
 # © 2017 Odoo SA <https://www.odoo.com>
 # © 2017 OCA <https://odoo-community.org>
 # License LGPL-3 (https://www.gnu.org/licenses/lgpl-3.0.en.html).
+import logging
+from collections import defaultdict
+
 from openerp import api, exceptions, fields, models
 from openerp.tools.translate import _
 import json
-from openerp.tools.float_utils import float_is_zero
+from openerp.tools.float_utils import float_compare, float_is_zero
+
+from .currency_converter import CurrencyConverter
+
+_logger = logging.getLogger(__name__)
 
 
 class AccountInvoice(models.Model):
     _inherit = 'account.invoice'
 
+    @api.multi
+    def _get_outstanding_keys(self):
+        """
+        :return dict: {invoice id: (account id, commercial partner id,
+            True for credit lines)} for the open invoices
+        """
+        partner_model = self.env['res.partner']
+        keys = {}
+        for record in self.filtered(lambda r: r.state == 'open'):
+            partner = partner_model._find_accounting_partner(
+                record.partner_id)
+            keys[record.id] = (
+                record.account_id.id, partner.id,
+                record.type in ('out_invoice', 'in_refund'))
+        return keys
+
+    @api.model
+    def _get_outstanding_domain(self, keys):
+        return [
+            ('account_id', 'in', list(set(k[0] for k in keys))),
+            ('partner_id', 'in', list(set(k[1] for k in keys))),
+            ('reconcile_ref', '=', False)]
+
+    @api.model
+    def _get_outstanding_side_domain(self, credit):
+        if credit:
+            return [('credit', '>', 0), ('debit', '=', 0)]
+        return [('credit', '=', 0), ('debit', '>', 0)]
+
+    @api.multi
+    def _get_outstanding_lines(self, keys=None):
+        """
+        Fetch the outstanding credit or debit lines of the open invoices
+        with one search, the lines being shared by the invoices of the same
+        account and commercial partner
+        :param keys: keys of the invoices, as returned by
+            _get_outstanding_keys
+        :return dict: {invoice id: account.move.line recordset}
+        """
+        move_line_model = self.env['account.move.line']
+        if keys is None:
+            keys = self._get_outstanding_keys()
+        if not keys:
+            return {}
+        lines = move_line_model.search(
+            self._get_outstanding_domain(keys.values()) +
+            ['|', ('credit', '>', 0), ('debit', '>', 0)])
+        line_ids = defaultdict(list)
+        for line in lines:
+            if line.debit and line.credit:
+                continue
+            line_ids[(line.account_id.id, line.partner_id.id,
+                      bool(line.credit))].append(line.id)
+        return dict((invoice_id, move_line_model.browse(line_ids[key]))
+                    for invoice_id, key in keys.iteritems())
+
+    @api.multi
+    def _get_outstanding_info(self, lines, converter, offset=0, limit=None,
+                              total=None):
+        """
+        Build the content of the outstanding widget of the invoice
+        :param lines: outstanding lines of the invoice, None to let the
+            widget load them with get_outstanding_info (lazy mode)
+        :param converter: CurrencyConverter of the request
+        :param offset, limit: page of the lines to include in the content
+        :param total: total number of outstanding lines, when ``lines`` is
+            already the requested page
+        :return dict: the widget content, with the total number of lines
+        """
+        self.ensure_one()
+        if self.type in ('out_invoice', 'in_refund'):
+            type_payment = _('Outstanding credits')
+        else:
+            type_payment = _('Outstanding debits')
+        info = {'title': type_payment, 'outstanding': True, 'content': [],
+                'invoice_id': self.id}
+        if lines is None:
+            info['lazy'] = True
+            return info
+        if total is None:
+            total = len(lines)
+            if offset or limit:
+                lines = lines[offset:limit and offset + limit or None]
+        info.update(total=total, offset=offset, limit=limit)
+        currency_id = self.currency_id
+        for line in lines:
+            amount_to_show = self._get_outstanding_amount(line, converter)
+            if float_is_zero(amount_to_show,
+                             precision_rounding=self.currency_id.rounding):
+                continue
+            info['content'].append({
+                'journal_name': line.ref or line.move_id.name,
+                'amount': amount_to_show,
+                'currency': currency_id.symbol,
+                'id': line.id,
+                'position': currency_id.position,
+                'digits': [69, self.currency_id.accuracy],
+            })
+        return info
+
+    @api.multi
+    def _get_outstanding_amount(self, line, converter):
+        """
+        :return float: residual amount of the outstanding line in the
+            currency of the invoice
+        """
+        self.ensure_one()
+        if line.currency_id and line.currency_id == self.currency_id:
+            return abs(line.amount_residual_currency)
+        return converter.compute(
+            line.company_id.currency_id, self.currency_id,
+            abs(line.amount_residual), line.date)
+
+    @api.model
+    def _is_outstanding_widget_lazy(self):
+        return bool(self.env['ir.values'].get_default(
+            'account.config.settings', 'lazy_outstanding_widget'))
+
     @api.multi
     def _compute_get_outstanding_info_JSON(self):
         """
         Get information for the outstanding payments and return it to the
         widget. This function has been re-used from 9.0.
+        The outstanding lines of all the invoices are fetched at once. In
+        lazy mode, only the title is given: the widget gets the content
+        with get_outstanding_info when the user asks for it.
         @attention: Source in
                     https://github.com/OCA/OCB/blob/9.0/addons/
                     account/models/account_invoice.py#L110
         @author:    Authors credited at README.rst
         """
+        if self._is_outstanding_widget_lazy():
+            for record in self:
+                info = False
+                if record.has_outstanding:
+                    info = record._get_outstanding_info(None, None)
+                record.outstanding_credits_debits_widget = json.dumps(info)
+            return
+        outstanding_lines = self._get_outstanding_lines()
+        converter = CurrencyConverter(self.env)
         for record in self:
-            record.outstanding_credits_debits_widget = json.dumps(False)
-            if record.state == 'open':
-                domain = [('account_id', '=', record.account_id.id),
-                          ('partner_id', '=', self.env['res.partner'].
-                           _find_accounting_partner(record.partner_id).id),
-                          ('reconcile_ref', '=', False)]
-                if record.type in ('out_invoice', 'in_refund'):
-                    domain.extend([('credit', '>', 0), ('debit', '=', 0)])
-                    type_payment = _('Outstanding credits')
-                else:
-                    domain.extend([('credit', '=', 0), ('debit', '>', 0)])
-                    type_payment = _('Outstanding debits')
-                info = {'title': '', 'outstanding': True, 'content': [],
-                        'invoice_id': record.id}
-                lines = self.env['account.move.line'].search(domain)
-                currency_id = record.currency_id
-                if len(lines) != 0:
-                    for line in lines:
-                        if line.currency_id and line.currency_id == \
-                                record.currency_id:
-                            amount_to_show = abs(line.amount_residual_currency)
-                        else:
-                            amount_to_show = line.company_id.currency_id. \
-                                with_context(date=line.date).compute(abs(
-                                    line.amount_residual), record.currency_id)
-                        if float_is_zero(amount_to_show,
-                                         precision_rounding=record.
-                                         currency_id.rounding):
-                            continue
-                        info['content'].append({
-                            'journal_name': line.ref or line.move_id.name,
-                            'amount': amount_to_show,
-                            'currency': currency_id.symbol,
-                            'id': line.id,
-                            'position': currency_id.position,
-                            'digits': [69, record.currency_id.accuracy],
-                        })
-                    info['title'] = type_payment
-                    record.outstanding_credits_debits_widget = json.dumps(info)
-                    record.has_outstanding = True
+            info = False
+            if outstanding_lines.get(record.id):
+                info = record._get_outstanding_info(
+                    outstanding_lines[record.id], converter)
+            record.outstanding_credits_debits_widget = json.dumps(info)
+
+    @api.multi
+    def _compute_has_outstanding(self):
+        """
+        Check the outstanding lines of the open invoices by counting them per
+        account and partner, without reading them
+        """
+        keys = self._get_outstanding_keys()
+        found = set()
+        move_line_model = self.env['account.move.line']
+        for credit in set(k[2] for k in keys.values()):
+            side = self._get_outstanding_side_domain(credit)
+            groups = move_line_model.read_group(
+                self._get_outstanding_domain(
+                    [k for k in keys.values() if k[2] == credit]) + side,
+                ['account_id', 'partner_id'], ['account_id', 'partner_id'],
+                lazy=False)
+            for group in groups:
+                found.add((group['account_id'][0], group['partner_id'][0],
+                           credit))
+        for record in self:
+            record.has_outstanding = keys.get(record.id) in found
+
+    @api.multi
+    def get_outstanding_info(self, offset=0, limit=80):
+        """
+        Return a page of the content of the outstanding widget of the
+        invoice, for the widget in lazy mode. Only the lines of the page
+        are read.
+        """
+        self.ensure_one()
+        key = self._get_outstanding_keys().get(self.id)
+        if not key:
+            return False
+        move_line_model = self.env['account.move.line']
+        domain = self._get_outstanding_domain([key]) + \
+            self._get_outstanding_side_domain(key[2])
+        total = move_line_model.search_count(domain)
+        if not total:
+            return False
+        lines = move_line_model.search(domain, offset=offset, limit=limit)
+        return self._get_outstanding_info(
+            lines, CurrencyConverter(self.env), offset=offset, limit=limit,
+            total=total)
 
     outstanding_credits_debits_widget = fields.Text(
         compute='_compute_get_outstanding_info_JSON')
     has_outstanding = fields.Boolean(
-        compute='_compute_get_outstanding_info_JSON')
+        compute='_compute_has_outstanding')
+
+    @api.multi
+    def _get_payment_info_data(self):
+        """
+        Read the payment lines of the invoices with their moves and
+        journals, in one read per model
+        :return tuple: dicts {id: values} of the payment lines, the moves
+            and the journals
+        """
+        payments = self.mapped('payment_ids')
+        payment_data = dict(
+            (values['id'], values) for values in payments.read(
+                ['name', 'credit', 'debit', 'date', 'move_id', 'journal_id'],
+                load='_classic_write'))
+        move_ids = set(v['move_id'] for v in payment_data.values())
+        journal_ids = set(v['journal_id'] for v in payment_data.values())
+        move_data = dict(
+            (values['id'], values) for values in
+            self.env['account.move'].browse(list(move_ids)).read(
+                ['name', 'ref']))
+        journal_data = dict(
+            (values['id'], values) for values in
+            self.env['account.journal'].browse(list(journal_ids)).read(
+                ['name']))
+        return payment_data, move_data, journal_data
 
     @api.multi
     @api.depends('payment_ids.amount_residual')
     def _compute_get_payment_info_JSON(self):
         """
         Returns the payment info for the invoice to the widget
+        The payment lines, moves and journals of all the invoices are read
+        at once.
         @attention: Source in
                     https://github.com/OCA/OCB/blob/9.0/addons/
                     account/models/account_invoice.py#L146
         @author:    Authors credited at README.rst
         """
+        payment_data, move_data, journal_data = \
+            self._get_payment_info_data()
         for record in self:
             record.payments_widget = json.dumps(False)
             if record.payment_ids:
                 info = {'title': _('Less Payment'), 'outstanding': False,
                         'content': []}
                 currency_id = record.currency_id
-                for payment in record.payment_ids:
+                for payment_id in record.payment_ids.ids:
+                    payment = payment_data[payment_id]
                     if record.type in ('out_invoice', 'in_refund'):
-                        amount = payment.credit
+                        amount = payment['credit']
                     elif record.type in ('in_invoice', 'out_refund'):
-                        amount = payment.debit
+                        amount = payment['debit']
                     if float_is_zero(amount,
                                      precision_rounding=record.currency_id.
                                      rounding):
                         continue
-                    payment_ref = payment.move_id.name
-                    if payment.move_id.ref:
-                        payment_ref += ' (' + payment.move_id.ref + ')'
+                    move = move_data[payment['move_id']]
+                    payment_ref = move['name']
+                    if move['ref']:
+                        payment_ref += ' (' + move['ref'] + ')'
                     info['content'].append({
-                        'name': payment.name,
-                        'journal_name': payment.journal_id.name,
+                        'name': payment['name'],
+                        'journal_name':
+                            journal_data[payment['journal_id']]['name'],
                         'amount': amount,
                         'currency': currency_id.symbol,
                         'digits': [69, currency_id.accuracy],
                         'position': currency_id.position,
-                        'date': payment.date,
-                        'payment_id': payment.id,
-                        'move_id': payment.move_id.id,
+                        'date': payment['date'],
+                        'payment_id': payment_id,
+                        'move_id': payment['move_id'],
                         'ref': payment_ref,
                     })
                 record.payments_widget = json.dumps(info)
@@ -127,30 +305,164 @@ class AccountInvoice(models.Model):
             line_to_reconcile += inv.move_id.line_id.filtered(
                 lambda r: not r.reconcile_ref and r.account_id.type in
                 ('payable', 'receivable'))
-        ir_values_obj = self.env['ir.values']
-        reconciliation_writeoff_account = ir_values_obj.get_default(
-            'account.config.settings', 'reconciliation_writeoff_account')
-        if not reconciliation_writeoff_account:
-            raise exceptions.MissingError(_('''Set the write-off account
-            in Settings -> Configuration -> Invoicing -> Write-Off account'''))
+        reconciliation_writeoff_account = \
+            self._get_reconciliation_writeoff_account()
         return (line_to_reconcile + payment_line).reconcile(
             writeoff_journal_id=self.journal_id.id,
             writeoff_period_id=self.env['account.period'].find().id,
             writeoff_acc_id=reconciliation_writeoff_account)
 
-    def assign_outstanding_credit(self, credit_aml_id):
+    def assign_outstanding_credit(self, credit_aml_id, converter=None):
         """
+        :param converter: CurrencyConverter shared by the calls of a request
         @attention: Source in
                     https://github.com/OCA/OCB/blob/9.0/addons/account/
                     models/account_invoice.py#L604
         @author:    Authors credited in README.rst
         """
         credit_aml = self.env['account.move.line'].browse(credit_aml_id)
+        self._prepare_outstanding_credit(
+            credit_aml, converter or CurrencyConverter(self.env))
+        return self.register_payment(credit_aml)
+
+    @api.model
+    def _get_reconciliation_writeoff_account(self):
+        ir_values_obj = self.env['ir.values']
+        reconciliation_writeoff_account = ir_values_obj.get_default(
+            'account.config.settings', 'reconciliation_writeoff_account')
+        if not reconciliation_writeoff_account:
+            raise exceptions.MissingError(_('''Set the write-off account
+            in Settings -> Configuration -> Invoicing -> Write-Off account'''))
+        return reconciliation_writeoff_account
+
+    @api.multi
+    def _prepare_outstanding_credit(self, credit_aml, converter):
+        """
+        Give the outstanding line the currency of the invoice before
+        reconciling them, when the invoice is in a foreign currency
+        """
+        self.ensure_one()
         if not credit_aml.currency_id and self.currency_id != \
                 self.company_id.currency_id:
             credit_aml.with_context(allow_amount_currency=True).write({
-                'amount_currency': self.company_id.currency_id.with_context(
-                    date=credit_aml.date).compute(credit_aml.balance,
-                                                  self.currency_id),
+                'amount_currency': converter.compute(
+                    self.company_id.currency_id, self.currency_id,
+                    credit_aml.balance, credit_aml.date),
                 'currency_id': self.currency_id.id})
-        return self.register_payment(credit_aml)
+
+    @api.multi
+    def auto_assign_outstanding_credits(self, strategy='oldest'):
+        """
+        Assign the outstanding credits (or debits) of the partners to their
+        open invoices, each invoice being reconciled with the lines assigned
+        to it. An invoice whose residual is not entirely covered is only
+        partially reconciled, no write-off is made for the difference.
+        The outstanding lines, the write-off account and the period are
+        fetched once for the whole recordset.
+        :param strategy: 'oldest' assigns the oldest lines to the oldest
+            invoices, as long as they do not exceed the residual of the
+            invoice; 'exact' only assigns a line of the same amount as the
+            residual of the invoice
+        :return dict: {invoice id: account.move.line recordset assigned}
+        """
+        if strategy not in ('oldest', 'exact'):
+            raise ValueError("Unknown assignment strategy %r" % strategy)
+        keys = self._get_outstanding_keys()
+        if not keys:
+            return {}
+        writeoff_acc_id = self._get_reconciliation_writeoff_account()
+        period = self.env['account.period'].find()
+        converter = CurrencyConverter(self.env)
+        outstanding_lines = self._get_outstanding_lines(keys=keys)
+        invoices_by_key = defaultdict(list)
+        for invoice in self.browse(keys.keys()):
+            invoices_by_key[keys[invoice.id]].append(invoice)
+        assigned = {}
+        for invoices in invoices_by_key.values():
+            available = sorted(outstanding_lines[invoices[0].id],
+                               key=lambda l: (l.date, l.id))
+            invoices.sort(
+                key=lambda i: (i.date_due or i.date_invoice or '', i.id))
+            for invoice in invoices:
+                lines = invoice._match_outstanding_lines(
+                    available, strategy, converter)
+                if not lines:
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        invoice._reconcile_outstanding_lines(
+                            lines, writeoff_acc_id, period, converter)
+                except exceptions.except_orm as e:
+                    # the values written before the failure are rolled back
+                    self.env.invalidate_all()
+                    _logger.warning(
+                        "Outstanding lines %s not assigned to invoice %s: "
+                        "%s", lines.ids, invoice.id, e)
+                    continue
+                for line in lines:
+                    available.remove(line)
+                assigned[invoice.id] = lines
+        return assigned
+
+    @api.multi
+    def _match_outstanding_lines(self, available, strategy, converter):
+        """
+        Select the outstanding lines to assign to the invoice according to
+        ``strategy``
+        :param available: outstanding lines not assigned yet, oldest first
+        :return: account.move.line recordset
+        """
+        self.ensure_one()
+        rounding = self.currency_id.rounding
+        remaining = self.residual
+        line_ids = []
+        for line in available:
+            amount = self._get_outstanding_amount(line, converter)
+            if float_is_zero(amount, precision_rounding=rounding):
+                continue
+            compare = float_compare(amount, remaining,
+                                    precision_rounding=rounding)
+            if strategy == 'exact':
+                if compare == 0:
+                    line_ids.append(line.id)
+                    break
+            elif compare <= 0:
+                line_ids.append(line.id)
+                remaining -= amount
+                if float_is_zero(remaining, precision_rounding=rounding):
+                    break
+        return self.env['account.move.line'].browse(line_ids)
+
+    @api.multi
+    def _reconcile_outstanding_lines(self, lines, writeoff_acc_id, period,
+                                     converter):
+        """
+        Reconcile the invoice with the outstanding lines assigned to it,
+        partially when they do not cover its residual. The lines of the
+        partial reconciliations of the invoice are reconciled with them,
+        so that the payments already made are not written off.
+        """
+        self.ensure_one()
+        for line in lines:
+            self._prepare_outstanding_credit(line, converter)
+        amount = sum(self._get_outstanding_amount(line, converter)
+                     for line in lines)
+        invoice_lines = self.move_id.line_id.filtered(
+            lambda r: not r.reconcile_id and r.account_id.type in
+            ('payable', 'receivable'))
+        to_reconcile = lines | invoice_lines | invoice_lines.mapped(
+            'reconcile_partial_id.line_partial_ids')
+        if float_compare(amount, self.residual,
+                         precision_rounding=self.currency_id.rounding) == 0:
+            to_reconcile.reconcile(
+                writeoff_journal_id=self.journal_id.id,
+                writeoff_period_id=period.id,
+                writeoff_acc_id=writeoff_acc_id)
+        else:
+            to_reconcile.reconcile_partial()
+
+    @api.model
+    def _cron_auto_assign_outstanding_credits(self, strategy='oldest'):
+        self.search([('state', '=', 'open')]).auto_assign_outstanding_credits(
+            strategy=strategy)
+        return True
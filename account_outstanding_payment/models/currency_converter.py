@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+
+class CurrencyConverter(object):
+    """
+    Convert amounts between currencies, reading each conversion rate once
+    per (from currency, to currency, date). Instances are meant to live as
+    long as a request: the rates are not refreshed.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.rates = {}
+
+    def get_rate(self, from_currency, to_currency, date):
+        if from_currency == to_currency:
+            return 1.0
+        key = (from_currency.id, to_currency.id, date)
+        if key not in self.rates:
+            self.rates[key] = self.env['res.currency'].with_context(
+                date=date)._get_conversion_rate(from_currency, to_currency)
+        return self.rates[key]
+
+    def compute(self, from_currency, to_currency, amount, date, round=True):
+        """ Convert ``amount`` like res.currency.compute at ``date`` """
+        amount *= self.get_rate(from_currency, to_currency, date)
+        if round:
+            return to_currency.round(amount)
+        return amount
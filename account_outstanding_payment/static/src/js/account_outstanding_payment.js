@@ -10,11 +10,53 @@ openerp.account_outstanding_payment = function(instance){
     openerp.account_outstanding_payment.ShowPaymentLineWidget = form_common.AbstractField.extend({
         
         render_value: function() {
-            var self = this;
             var info = JSON.parse(this.get('value'));
+            if (info !== false && info.lazy) {
+                this.render_lazy(info);
+            }
+            else {
+                this.render_info(info);
+            }
+        },
+
+        render_lazy: function(info) {
+            // the content is only loaded when the user asks for it
+            var self = this;
+            this.$el.html(QWeb.render('ShowOutstandingLazy', {
+                'title': info.title
+            }));
+            this.$('.outstanding_load').click(function(){
+                self.load_outstanding(info.invoice_id, 0, []);
+            });
+        },
+
+        load_outstanding: function(invoice_id, offset, previous_lines) {
+            var self = this;
+            new Model("account.invoice")
+                .call("get_outstanding_info", [invoice_id, offset])
+                .then(function (result) {
+                    if (result !== false) {
+                        result.content = previous_lines.concat(result.content);
+                    }
+                    self.render_info(result);
+                    if (result !== false && result.offset + result.limit < result.total) {
+                        self.$el.append(QWeb.render('ShowOutstandingMore', {}));
+                        self.$('.outstanding_load').click(function(){
+                            self.load_outstanding(
+                                invoice_id, result.offset + result.limit,
+                                result.content);
+                        });
+                    }
+                });
+        },
+
+        render_info: function(info) {
+            var self = this;
             var invoice_id = info.invoice_id;
             if (info !== false) {
-                _.each(info.content, function(k,v){
+                // format copies, the raw lines are kept to load more lines
+                var lines = _.map(info.content, _.clone);
+                _.each(lines, function(k,v){
                     k.index = v;
                     k.amount = formats.format_value(k.amount, {type: "float", digits: k.digits});
                     if (k.date){
@@ -22,7 +64,7 @@ openerp.account_outstanding_payment = function(instance){
                     }
                 });
                 this.$el.html(QWeb.render('ShowPaymentInfo', {
-                    'lines': info.content, 
+                    'lines': lines, 
                     'outstanding': info.outstanding, 
                     'title': info.title
                 }));
@@ -37,15 +79,15 @@ openerp.account_outstanding_payment = function(instance){
                 _.each(this.$('.js_payment_info'), function(k, v){
                     var options = {
                         'content': QWeb.render('PaymentPopOver', {
-                                'name': info.content[v].name, 
-                                'journal_name': info.content[v].journal_name, 
-                                'date': info.content[v].date,
-                                'amount': info.content[v].amount,
-                                'currency': info.content[v].currency,
-                                'position': info.content[v].position,
-                                'payment_id': info.content[v].payment_id,
-                                'move_id': info.content[v].move_id,
-                                'ref': info.content[v].ref,
+                                'name': lines[v].name, 
+                                'journal_name': lines[v].journal_name, 
+                                'date': lines[v].date,
+                                'amount': lines[v].amount,
+                                'currency': lines[v].currency,
+                                'position': lines[v].position,
+                                'payment_id': lines[v].payment_id,
+                                'move_id': lines[v].move_id,
+                                'ref': lines[v].ref,
                                 }),
                         'html': true,
                         'placement': 'left',
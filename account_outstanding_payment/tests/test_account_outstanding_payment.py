@@ -5,15 +5,20 @@
 # License LGPL-3 (https://www.gnu.org/licenses/lgpl-3.0.en.html).
 import json
 from openerp.tests import common
-from openerp import fields
+from openerp import exceptions, fields
+from openerp.addons.account_outstanding_payment.models.currency_converter \
+    import CurrencyConverter
 
 
 class TestAccountOutstandingPayments(common.TransactionCase):
 
     post_install = True
 
-    def test_account_outstanding_payment(self):
-        ir_values = self.env['ir.values']
+    def _create_invoice_with_outstanding(self):
+        """Create an open invoice of 100 whose partner has an outstanding
+        payment of 50
+        :return: (invoice, account used for the payment)
+        """
         res_partner_model = self.env['res.partner']
         sale_order_model = self.env['sale.order']
         product_product_model = self.env['product.product']
@@ -56,10 +61,34 @@ class TestAccountOutstandingPayments(common.TransactionCase):
                      'account_id': account_id.id,
                      'payment_option': 'without_writeoff'})
         proforma_voucher.button_proforma_voucher()
+        return account_invoice, account_id
+
+    def test_account_outstanding_payment(self):
+        ir_values = self.env['ir.values']
+        account_invoice, account_id = self._create_invoice_with_outstanding()
         # check if the widget shows the remaining money to be paid
         self.assertEqual(json.loads(
             account_invoice.outstanding_credits_debits_widget)[
                 'content'][0]['amount'], 50.0, 'Incorrect payment info')
+        self.assertTrue(account_invoice.has_outstanding)
+        # in lazy mode, the widget content is loaded on demand
+        ir_values.set_default(
+            'account.config.settings', 'lazy_outstanding_widget', True)
+        account_invoice.invalidate_cache()
+        lazy_info = json.loads(
+            account_invoice.outstanding_credits_debits_widget)
+        self.assertTrue(lazy_info['lazy'])
+        self.assertFalse(lazy_info['content'])
+        page = account_invoice.get_outstanding_info(limit=1)
+        self.assertEqual(len(page['content']), 1)
+        self.assertEqual(page['content'][0]['amount'], 50.0)
+        self.assertEqual(page['total'], 1)
+        page = account_invoice.get_outstanding_info(offset=1, limit=1)
+        self.assertEqual(page['total'], 1)
+        self.assertFalse(page['content'])
+        ir_values.set_default(
+            'account.config.settings', 'lazy_outstanding_widget', False)
+        account_invoice.invalidate_cache()
         # see if the payments_widget shows the payments being done
         ir_values.set_default(
             'account.config.settings',
@@ -68,6 +97,171 @@ class TestAccountOutstandingPayments(common.TransactionCase):
         account_move_line_id = json.loads(
             account_invoice.outstanding_credits_debits_widget)[
                 'content'][0]['id']
+        self.assertIn(
+            account_move_line_id,
+            account_invoice._get_outstanding_lines()[account_invoice.id].ids)
         account_invoice.assign_outstanding_credit(account_move_line_id)
         self.assertEqual(json.loads(account_invoice.payments_widget)[
             'content'][0]['amount'], 50, 'Incorrect outstanding credit')
+
+    def test_auto_assign_outstanding_credits(self):
+        account_invoice, account_id = self._create_invoice_with_outstanding()
+        self.env['ir.values'].set_default(
+            'account.config.settings',
+            'reconciliation_writeoff_account',
+            account_id.id)
+        with self.assertRaises(ValueError):
+            account_invoice.auto_assign_outstanding_credits(strategy='best')
+        outstanding = account_invoice._get_outstanding_lines()[
+            account_invoice.id]
+        self.assertTrue(outstanding)
+        assigned = account_invoice.auto_assign_outstanding_credits()
+        self.assertEqual(assigned[account_invoice.id], outstanding)
+        for line in outstanding:
+            self.assertTrue(line.reconcile_ref)
+        account_invoice.invalidate_cache()
+        self.assertFalse(account_invoice.has_outstanding)
+        self.assertFalse(
+            account_invoice.auto_assign_outstanding_credits())
+
+    def _create_outstanding_payment(self, invoice, amount, ref=False):
+        """Create a payment of ``amount`` of the partner of the invoice,
+        not reconciled with any invoice
+        :return: receivable / payable line of the payment
+        """
+        journal_cash = self.env['account.journal'].search(
+            [('type', '=', 'cash')], limit=1)
+        partner = self.env['res.partner']._find_accounting_partner(
+            invoice.partner_id)
+        move = self.env['account.move'].create({
+            'journal_id': journal_cash.id,
+            'period_id': self.env['account.period'].find().id,
+            'ref': ref,
+            'line_id': [
+                (0, 0, {'name': 'Payment',
+                        'account_id': invoice.account_id.id,
+                        'partner_id': partner.id,
+                        'credit': amount}),
+                (0, 0, {'name': 'Payment',
+                        'account_id':
+                            journal_cash.default_debit_account_id.id,
+                        'partner_id': partner.id,
+                        'debit': amount})],
+        })
+        move.post()
+        return move.line_id.filtered(
+            lambda l: l.account_id == invoice.account_id)
+
+    def test_auto_assign_outstanding_credits_twice(self):
+        account_invoice, account_id = self._create_invoice_with_outstanding()
+        self.env['ir.values'].set_default(
+            'account.config.settings',
+            'reconciliation_writeoff_account',
+            account_id.id)
+        # the first run only pays the invoice partially
+        first = account_invoice.auto_assign_outstanding_credits()[
+            account_invoice.id]
+        self.assertTrue(first.reconcile_partial_id)
+        account_invoice.invalidate_cache()
+        self.assertEqual(account_invoice.state, 'open')
+        self.assertEqual(account_invoice.residual, 50.0)
+        # the second run pays the rest, with the first payment
+        second = self._create_outstanding_payment(account_invoice, 50.0)
+        self.assertEqual(
+            account_invoice.auto_assign_outstanding_credits()[
+                account_invoice.id], second)
+        account_invoice.invalidate_cache()
+        self.assertEqual(account_invoice.state, 'paid')
+        reconcile = second.reconcile_id
+        self.assertTrue(reconcile)
+        self.assertEqual(first.reconcile_id, reconcile)
+        # nothing was written off
+        invoice_lines = account_invoice.move_id.line_id.filtered(
+            lambda l: l.account_id == account_invoice.account_id)
+        self.assertEqual(reconcile.line_id, invoice_lines | first | second)
+
+    def test_auto_assign_outstanding_credits_failure(self):
+        first, account_id = self._create_invoice_with_outstanding()
+        second = first.copy()
+        second.signal_workflow('invoice_open')
+        self.env['ir.values'].set_default(
+            'account.config.settings',
+            'reconciliation_writeoff_account',
+            account_id.id)
+        outstanding = first._get_outstanding_lines()[first.id]
+        self.assertEqual(len(outstanding), 1)
+        # the reconciliation of the first invoice fails after writing on
+        # the outstanding line
+        invoice_class = type(first)
+        reconcile = invoice_class._reconcile_outstanding_lines
+
+        def _reconcile_outstanding_lines(invoice, lines, *args):
+            if invoice == first:
+                lines.with_context(allow_amount_currency=True).write({
+                    'currency_id': self.env.ref('base.USD').id,
+                    'amount_currency': -60.0})
+                raise exceptions.except_orm('Error', 'Reconciliation failed')
+            return reconcile(invoice, lines, *args)
+        invoice_class._reconcile_outstanding_lines = \
+            _reconcile_outstanding_lines
+        self.addCleanup(setattr, invoice_class,
+                        '_reconcile_outstanding_lines', reconcile)
+        assigned = (first | second).auto_assign_outstanding_credits()
+        # the line goes to the next invoice, without the rolled back values
+        self.assertEqual(assigned.keys(), [second.id])
+        self.assertEqual(assigned[second.id], outstanding)
+        self.assertFalse(outstanding.currency_id)
+        self.assertTrue(outstanding.reconcile_ref)
+        first.invalidate_cache()
+        self.assertFalse(first.payment_ids)
+
+    def test_payments_widget_batch(self):
+        invoices = self.env['account.invoice']
+        for index in range(2):
+            invoice, account_id = self._create_invoice_with_outstanding()
+            self.env['ir.values'].set_default(
+                'account.config.settings',
+                'reconciliation_writeoff_account',
+                account_id.id)
+            invoice.auto_assign_outstanding_credits()
+            self._create_outstanding_payment(
+                invoice, 50.0, ref='PAY%s' % index)
+            invoice.auto_assign_outstanding_credits()
+            invoices |= invoice
+        invoices.invalidate_cache()
+        self.assertEqual(invoices.mapped('state'), ['paid', 'paid'])
+        # the widgets of both invoices are built at once
+        invoices._compute_get_payment_info_JSON()
+        for index, invoice in enumerate(invoices):
+            content = json.loads(invoice.payments_widget)['content']
+            self.assertEqual(len(content), len(invoice.payment_ids))
+            self.assertEqual(
+                sorted(payment['payment_id'] for payment in content),
+                sorted(invoice.payment_ids.ids))
+            refs = []
+            for payment in content:
+                line = self.env['account.move.line'].browse(
+                    payment['payment_id'])
+                self.assertEqual(payment['journal_name'],
+                                 line.journal_id.name)
+                self.assertEqual(payment['move_id'], line.move_id.id)
+                ref = line.move_id.name
+                if line.move_id.ref:
+                    ref += ' (%s)' % line.move_id.ref
+                self.assertEqual(payment['ref'], ref)
+                refs.append(payment['ref'])
+            self.assertTrue(
+                any(ref.endswith(' (PAY%s)' % index) for ref in refs))
+
+    def test_currency_converter(self):
+        eur = self.env.ref('base.EUR')
+        usd = self.env.ref('base.USD')
+        date = fields.Date.today()
+        converter = CurrencyConverter(self.env)
+        self.assertEqual(converter.compute(eur, eur, 10.004, date), 10.0)
+        self.assertEqual(
+            converter.compute(eur, usd, 10.0, date),
+            eur.with_context(date=date).compute(10.0, usd))
+        self.assertEqual(converter.rates.keys(), [(eur.id, usd.id, date)])
+        converter.compute(eur, usd, 20.0, date)
+        self.assertEqual(len(converter.rates), 1)
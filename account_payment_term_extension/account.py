@@ -22,15 +22,11 @@
 #
 ##############################################################################
 
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import time
-
-from openerp import models, fields, api
-from openerp.tools.float_utils import float_round
+from openerp import models, fields, api, tools
 
 import openerp.addons.decimal_precision as dp
-from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
+
+from .payment_term_schedule import PaymentTermSchedule, compute_rule_amount
 
 
 class AccountPaymentTermLine(models.Model):
@@ -65,53 +61,86 @@ class AccountPaymentTermLine(models.Model):
         """
         self.ensure_one()
         prec = self.env['decimal.precision'].precision_get('Account')
-        if self.value == 'fixed':
-            return float_round(self.value_amount, precision_digits=prec)
-        elif self.value == 'procent':
-            amt = total_amount * self.value_amount
-            if self.amount_round:
-                amt = float_round(amt, precision_rounding=self.amount_round)
-            return float_round(amt, precision_digits=prec)
-        elif self.value == 'balance':
-            return float_round(remaining_amount,  precision_digits=prec)
-        return None
+        return compute_rule_amount(
+            self, total_amount, remaining_amount, prec)
+
+    @api.model
+    def _touch_payment_terms(self, term_ids):
+        """Update the write date of the payment terms whose lines changed,
+        so that their compiled schedule is not used any more
+        """
+        term_ids = list(set(term_ids))
+        if not term_ids:
+            return
+        self.env.cr.execute("""
+            UPDATE account_payment_term
+            SET write_date = (now() at time zone 'UTC'), write_uid = %s
+            WHERE id IN %s
+            """, (self.env.uid, tuple(term_ids)))
+        term_model = self.env['account.payment.term']
+        term_model.invalidate_cache(['write_date', 'write_uid'], term_ids)
+        term_model.clear_caches()
+
+    @api.model
+    def create(self, vals):
+        line = super(AccountPaymentTermLine, self).create(vals)
+        self._touch_payment_terms(line.payment_id.ids)
+        return line
+
+    @api.multi
+    def write(self, vals):
+        term_ids = self.mapped('payment_id').ids
+        res = super(AccountPaymentTermLine, self).write(vals)
+        self._touch_payment_terms(term_ids + self.mapped('payment_id').ids)
+        return res
+
+    @api.multi
+    def unlink(self):
+        term_ids = self.mapped('payment_id').ids
+        res = super(AccountPaymentTermLine, self).unlink()
+        self._touch_payment_terms(term_ids)
+        return res
 
 
 class AccountPaymentTerm(models.Model):
     _inherit = "account.payment.term"
 
+    @tools.ormcache(skiparg=3)
+    def _get_schedule(self, cr, uid, term_id, write_date, prec):
+        """Compile the schedule of a payment term, cached per write date of
+        the term, which is also updated when one of its lines changes
+        """
+        term = self.browse(cr, uid, term_id)
+        return PaymentTermSchedule.from_lines(term.line_ids, prec)
+
+    def _get_schedules(self, cr, uid, ids, context=None):
+        """Return the compiled schedules of the payment terms
+
+            :returns: dict {term id: PaymentTermSchedule}
+        """
+        prec = self.pool['decimal.precision'].precision_get(
+            cr, uid, 'Account')
+        cr.execute(
+            "SELECT id, write_date FROM account_payment_term WHERE id IN %s",
+            (tuple(ids),))
+        return dict(
+            (term_id, self._get_schedule(cr, uid, term_id, write_date, prec))
+            for term_id, write_date in cr.fetchall())
+
     def compute(self, cr, uid, id, value, date_ref=False, context=None):
         """Complete overwrite of compute method to add rounding on line
         computing and also to handle weeks and months
         """
-        obj_precision = self.pool['decimal.precision']
-        prec = obj_precision.precision_get(cr, uid, 'Account')
-        if not date_ref:
-            date_ref = datetime.now().strftime(DEFAULT_SERVER_DATE_FORMAT)
-        pt = self.browse(cr, uid, id, context=context)
-        amount = value
-        result = []
-        for line in pt.line_ids:
-            amt = line.compute_line_amount(value, amount)
-            if not amt:
-                continue
-
-            next_date = fields.Date.from_string(date_ref)
-            if line.start_with_end_month:
-                next_date += relativedelta(day=1, months=1, days=-1)
-            next_date += relativedelta(
-                days=line.days, weeks=line.weeks, months=line.months)
-            if line.days2 < 0:
-                # Getting 1st of next month
-                next_date += relativedelta(day=1, months=1, days=line.days2)
-            if line.days2 > 0:
-                next_date += relativedelta(day=line.days2, months=1)
-            result.append(
-                (fields.Date.to_string(next_date), amt))
-            amount -= amt
-
-        amount = reduce(lambda x, y: x + y[1], result, 0.0)
-        dist = round(value - amount, prec)
-        if dist:
-            result.append((time.strftime(DEFAULT_SERVER_DATE_FORMAT), dist))
-        return result
+        schedule = self._get_schedules(cr, uid, [id], context=context)[id]
+        return schedule.compute(value, date_ref)
+
+    def compute_batch(self, cr, uid, id, pairs, context=None):
+        """Split many amounts according to the payment term at once, e.g.
+        to forecast the due amounts of all the open invoices
+
+            :param pairs: list of (amount, date_ref)
+            :returns: list of the results of compute, in the order of
+                ``pairs``
+        """
+        schedule = self._get_schedules(cr, uid, [id], context=context)[id]
+        return schedule.compute_batch(pairs)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from collections import namedtuple
+import time
+
+from dateutil.relativedelta import relativedelta
+
+from openerp import fields
+from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
+from openerp.tools.float_utils import float_round
+
+PaymentTermRule = namedtuple('PaymentTermRule', [
+    'value', 'value_amount', 'amount_round', 'days', 'weeks', 'months',
+    'days2', 'start_with_end_month'])
+
+
+def compute_rule_amount(rule, total_amount, remaining_amount, prec):
+    """Compute the amount of a payment term line rule.
+
+        :param rule: PaymentTermRule or account.payment.term.line record
+        :param total_amount: total balance to pay
+        :param remaining_amount: total amount minus sum of previous lines
+            computed amount
+        :param prec: number of digits of the amounts
+        :returns: computed amount for this line
+    """
+    if rule.value == 'fixed':
+        return float_round(rule.value_amount, precision_digits=prec)
+    elif rule.value == 'procent':
+        amt = total_amount * rule.value_amount
+        if rule.amount_round:
+            amt = float_round(amt, precision_rounding=rule.amount_round)
+        return float_round(amt, precision_digits=prec)
+    elif rule.value == 'balance':
+        return float_round(remaining_amount, precision_digits=prec)
+    return None
+
+
+def compute_rule_date(rule, date_ref):
+    """Compute the due date of a payment term line rule.
+
+        :param rule: PaymentTermRule or account.payment.term.line record
+        :param date_ref: date object the payment term starts from
+        :returns: due date object
+    """
+    next_date = date_ref
+    if rule.start_with_end_month:
+        next_date += relativedelta(day=1, months=1, days=-1)
+    next_date += relativedelta(
+        days=rule.days, weeks=rule.weeks, months=rule.months)
+    if rule.days2 < 0:
+        # Getting 1st of next month
+        next_date += relativedelta(day=1, months=1, days=rule.days2)
+    if rule.days2 > 0:
+        next_date += relativedelta(day=rule.days2, months=1)
+    return next_date
+
+
+class PaymentTermSchedule(object):
+    """Compiled schedule of a payment term.
+
+    The rules of the payment term lines are read once; the schedule then
+    computes the due dates and amounts of any number of
+    ``(value, date_ref)`` pairs without accessing the database.
+    """
+
+    def __init__(self, rules, prec):
+        self.rules = tuple(rules)
+        self.prec = prec
+
+    @classmethod
+    def from_lines(cls, lines, prec):
+        """Compile the schedule of account.payment.term.line records"""
+        return cls([PaymentTermRule(
+            line.value, line.value_amount, line.amount_round, line.days,
+            line.weeks, line.months, line.days2, line.start_with_end_month)
+            for line in lines], prec)
+
+    def due_dates(self, date_ref):
+        """:returns: tuple of the due dates of the rules, as strings"""
+        date = fields.Date.from_string(date_ref)
+        return tuple(fields.Date.to_string(compute_rule_date(rule, date))
+                     for rule in self.rules)
+
+    def compute(self, value, date_ref=False, due_dates=None):
+        """Split ``value`` according to the payment term.
+
+            :param due_dates: due dates of the rules for ``date_ref``, as
+                returned by ``due_dates``
+            :returns: list of (due date, amount)
+        """
+        if not date_ref:
+            date_ref = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        if due_dates is None:
+            due_dates = self.due_dates(date_ref)
+        amount = value
+        result = []
+        for rule, due_date in zip(self.rules, due_dates):
+            amt = compute_rule_amount(rule, value, amount, self.prec)
+            if not amt:
+                continue
+            result.append((due_date, amt))
+            amount -= amt
+
+        amount = reduce(lambda x, y: x + y[1], result, 0.0)
+        dist = round(value - amount, self.prec)
+        if dist:
+            result.append((time.strftime(DEFAULT_SERVER_DATE_FORMAT), dist))
+        return result
+
+    def compute_batch(self, pairs):
+        """Split many values according to the payment term, computing the
+        due dates only once per reference date.
+
+            :param pairs: iterable of (value, date_ref)
+            :returns: list of the results of ``compute``, in the order of
+                ``pairs``
+        """
+        today = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        due_dates = {}
+        result = []
+        for value, date_ref in pairs:
+            date_ref = date_ref or today
+            if date_ref not in due_dates:
+                due_dates[date_ref] = self.due_dates(date_ref)
+            result.append(self.compute(value, date_ref, due_dates[date_ref]))
+        return result
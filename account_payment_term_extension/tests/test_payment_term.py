@@ -57,3 +57,69 @@ class TestAccountPaymentTerm(TransactionCase):
             res[0][0],
             '2015-03-16',
             'Error in the compute of payment terms with weeks')
+
+    def test_02_compute_cached_schedule(self):
+        cr, uid = self.cr, self.uid
+        payterm_id = self.account_payment_term.create(
+            cr, uid, {
+                'name': '30% now, balance in 1 month',
+                'line_ids': [
+                    (0, 0, {'value': 'procent',
+                            'value_amount': 0.3,
+                            'amount_round': 1.0,
+                            'days': 0}),
+                    (0, 0, {'value': 'balance',
+                            'days': 0,
+                            'months': 1})]
+                })
+        schedule = self.account_payment_term._get_schedules(
+            cr, uid, [payterm_id])[payterm_id]
+        self.assertIs(
+            self.account_payment_term._get_schedules(
+                cr, uid, [payterm_id])[payterm_id],
+            schedule, 'The schedule of the payment term is not cached')
+        res = self.account_payment_term.compute(
+            cr, uid, payterm_id, 100.55, date_ref='2015-01-30')
+        self.assertEquals(
+            res, [('2015-01-30', 30.0), ('2015-02-28', 70.55)])
+        self.assertEquals(
+            schedule.compute_batch(
+                [(100.55, '2015-01-30'), (10.0, '2015-03-31')]),
+            [res, [('2015-03-31', 3.0), ('2015-04-30', 7.0)]])
+        # changing a line compiles the schedule again
+        payterm = self.account_payment_term.browse(cr, uid, payterm_id)
+        payterm.line_ids[0].value_amount = 0.5
+        res = self.account_payment_term.compute(
+            cr, uid, payterm_id, 100.55, date_ref='2015-01-30')
+        self.assertEquals(
+            res, [('2015-01-30', 50.0), ('2015-02-28', 50.55)])
+
+    def test_03_compute_batch(self):
+        cr, uid = self.cr, self.uid
+        payterm_id = self.account_payment_term.create(
+            cr, uid, {
+                'name': 'Half end of month 45 days, balance end of month',
+                'line_ids': [
+                    (0, 0, {'value': 'procent',
+                            'value_amount': 0.5,
+                            'amount_round': 5.0,
+                            'start_with_end_month': True,
+                            'days': 45}),
+                    (0, 0, {'value': 'balance',
+                            'days': 0,
+                            'weeks': 2,
+                            'months': 1,
+                            'days2': -1})]
+                })
+        pairs = [(123.0, '2015-01-10'), (40.0, '2015-02-20'),
+                 (123.0, '2015-01-10')]
+        res = self.account_payment_term.compute_batch(
+            cr, uid, payterm_id, pairs)
+        self.assertEquals(res, [
+            [('2015-03-17', 60.0), ('2015-02-28', 63.0)],
+            [('2015-04-14', 20.0), ('2015-04-30', 20.0)],
+            [('2015-03-17', 60.0), ('2015-02-28', 63.0)]])
+        self.assertEquals(res, [
+            self.account_payment_term.compute(
+                cr, uid, payterm_id, amount, date_ref=date_ref)
+            for amount, date_ref in pairs])